@@ -1,39 +1,24 @@
 import os
 import random
-import json
+import sys
+import time
 from base64 import b64encode
-from dataclasses import dataclass
 from asyncio import run
-import time
+from pathlib import Path
 
 from ipv8.community import Community, CommunitySettings
 from ipv8.configuration import ConfigBuilder, Strategy, WalkerDefinition, default_bootstrap_defs
 from ipv8.lazy_community import lazy_wrapper
-from ipv8.messaging.payload_dataclass import overwrite_dataclass
 from ipv8.types import Peer
 from ipv8.util import run_forever
 from ipv8_service import IPv8
 
-# We are using a custom dataclass implementation.
-dataclass = overwrite_dataclass(dataclass)
-
-@dataclass(
-    msg_id=1
-)  # The value 1 identifies this message and must be unique per community.
-class Transaction:
-    """ Represents a basic transaction. """
-    sender: str
-    receiver: str
-    amount: int
-    nonce: int = 1
-    ts: int = int(time.time())
-
-@dataclass(msg_id=2)  # The value 2 identifies this message and must be unique per community.
-class SignedTransaction:
-    """ Represents a signed transaction including a signature and public key. """
-    transaction: Transaction
-    signature: str
-    public_key: str
+# The transaction messages and the send coalescer are shared with the validator and the lab-template miner
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "lab-template" / "src" / "algorithms" / "mining"))
+
+from transaction import Transaction, SignedTransaction, TransactionBatch
+from coalescer import SendCoalescer
+
 
 class MyCommunity(Community):
     """ Custom community for handling transactions. """
@@ -44,19 +29,25 @@ class MyCommunity(Community):
         super().__init__(settings)
         self.counter = 1
         self.max_messages = 3
+        # Transactions to the same peer within 50 ms share one message
+        self.coalescer = SendCoalescer(self.send_batch, window=0.05, max_count=64)
         self.add_message_handler(SignedTransaction, self.on_transaction)
 
     def started(self) -> None:
         """ Start creating transactions periodically. """
         self.register_task("create_transaction", self.create_transaction, interval=1.0, delay=1.0)
 
+    def send_batch(self, peer: Peer, signed_txs) -> None:
+        """ Send the coalesced transactions for one peer as a single batch. """
+        self.ez_send(peer, TransactionBatch(signed_txs))
+
     def serialize_transaction(self, tx: Transaction) -> bytes:
         """ Serialize transaction to bytes for storage or transmission. """
-        return json.dumps(tx.__dict__, sort_keys=True).encode()
+        return tx.encode()
 
     def deserialize_transaction(self, data: bytes) -> Transaction:
         """ Deserialize bytes back into Transaction object. """
-        return Transaction(**json.loads(data))
+        return Transaction.decode(data)
 
     def node_id_from_peer(self, peer: Peer) -> int:
         """ Extract node ID from a peer (placeholder implementation). """
@@ -75,7 +66,8 @@ class MyCommunity(Community):
             b64encode(self.my_peer.public_key.key_to_bin()).decode('utf-8'),
             b64encode(peer.public_key.key_to_bin()).decode('utf-8'),
             10,
-            self.counter
+            self.counter,
+            int(time.time()),
         )
         tx_data = self.serialize_transaction(tx)
         signature = b64encode(self.crypto.create_signature(self.my_peer.key, tx_data)).decode('utf-8')
@@ -84,7 +76,7 @@ class MyCommunity(Community):
 
         self.counter += 1
         print(f'[Node {self.my_peer.mid}] Sending transaction {tx.nonce} to {peer_id}')
-        self.ez_send(peer, signed_tx)
+        self.coalescer.add(peer, signed_tx)
 
         if self.counter > self.max_messages:
             self.cancel_pending_task("create_transaction")
@@ -1,10 +1,9 @@
-import json
+import asyncio
+import sys
 from base64 import b64decode
-from collections import defaultdict
-from dataclasses import dataclass
+from collections import defaultdict, OrderedDict
 from asyncio import run
-import time
-from hashlib import sha256
+from pathlib import Path
 
 from ipv8.community import Community, CommunitySettings
 from ipv8.configuration import (
@@ -14,64 +13,22 @@ from ipv8.configuration import (
     default_bootstrap_defs,
 )
 from ipv8.lazy_community import lazy_wrapper
-from ipv8.messaging.payload_dataclass import overwrite_dataclass
 from ipv8.types import Peer
 from ipv8.util import run_forever
 from ipv8_service import IPv8
 
-# We are using a custom dataclass implementation.
-dataclass = overwrite_dataclass(dataclass)
-
-@dataclass(
-    msg_id=1
-)  # The value 1 identifies this message and must be unique per community.
-class Transaction:
-    """ Represents a basic transaction. """
-    sender: str
-    receiver: str
-    amount: int
-    nonce: int = 1
-    ts: int = time.time()
-
-@dataclass(msg_id=2)  # The value 2 identifies this message and must be unique per community.
-class SignedTransaction:
-    """ Represents a signed transaction including a signature and public key. """
-    transaction: Transaction
-    signature: str
-    public_key: str
-
-class MerkleTree:
-    """ Implementation of a Merkle Tree for storing transaction hashes. """
-
-    def __init__(self):
-        self.leaves = []
-        self.levels = []
-
-    def add_leaf(self, data, do_hash=True):
-        """ Add a leaf to the Merkle Tree, optionally hashing the data. """
-        if do_hash:
-            data = sha256(data.encode('utf-8')).hexdigest()
-        self.leaves.append(data)
-        self.build_tree()
-
-    def build_tree(self):
-        """ Build the Merkle Tree from the leaves. """
-        self.levels = [self.leaves]
-        current_level = self.leaves
-        while len(current_level) > 1:
-            new_level = []
-            for i in range(0, len(current_level), 2):
-                left = current_level[i]
-                right = current_level[i + 1] if i + 1 < len(current_level) else left
-                new_level.append(sha256((left + right).encode('utf-8')).hexdigest())
-            current_level = new_level
-            self.levels.append(current_level)
-
-    def get_root(self):
-        """ Get the root hash of the Merkle Tree. """
-        if self.levels:
-            return self.levels[-1][0]
-        return None
+# The building blocks of the validator are shared with the lab-template miner
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "lab-template" / "src" / "algorithms" / "mining"))
+
+from merkle_tree import MerkleAccumulator
+from mempool import Mempool
+from signature_verifier import SignatureVerifier
+from transaction import Transaction, SignedTransaction, TransactionBatch, TransactionInventory, TransactionRequest
+from inventory import InventoryGossip, pack_ids, unpack_ids
+from seen_filter import SeenFilter
+from coalescer import SendCoalescer
+from batch_trigger import BatchTrigger
+
 
 class ValidatorCommunity(Community):
     """ Custom community for validating transactions. """
@@ -82,62 +39,122 @@ class ValidatorCommunity(Community):
         super().__init__(settings)
         self.executed_checks = 0
         self.balances = defaultdict(lambda: 1000)
-        self.pending_txs = []
-        self.saved_txs_hashes = {}
+        # Highest nonce applied per sender; transactions start at nonce 1
+        self.nonces = defaultdict(int)
+        self.pending_txs = Mempool(
+            max_count=10000,
+            max_bytes=4 * 1024 * 1024,
+            tx_id=self.generate_tx_id,
+            tx_size=lambda tx: len(self.serialize_transaction(tx)),
+        )
+        # Ids of transactions seen recently, in bounded memory (see SeenFilter)
+        self.seen_txs = SeenFilter(window=600.0, capacity=100000, fp_rate=0.001)
+        self.verifier = SignatureVerifier()
         self.finalized_txs = []
-        self.merkle_tree = MerkleTree()
+        self.merkle_tree = MerkleAccumulator()
+        self.gossip = InventoryGossip(request_timeout=2.0)
+        # Recently accepted signed transactions, served to peers that request them
+        self.known_txs = OrderedDict()
+        self.max_known_txs = 10000
+        self.coalescer = SendCoalescer(self.send_batch, window=0.05, max_count=64)
+        # Accepted transactions are applied within 5 ms, or right away once 256 are waiting
+        self.apply_trigger = BatchTrigger(self.check_transactions, max_delay=0.005, batch_size=256)
         self.add_message_handler(SignedTransaction, self.on_transaction)
+        self.add_message_handler(TransactionBatch, self.on_transaction_batch)
+        self.add_message_handler(TransactionInventory, self.on_inventory)
+        self.add_message_handler(TransactionRequest, self.on_transaction_request)
 
     def started(self) -> None:
-        """ Start periodic transaction checks. """
-        self.register_task(
-            "check_transactions", self.check_transactions, interval=1.0, delay=1.0
-        )
+        """ Start the signature workers and the periodic gossip tasks. """
+        self.register_task("verify_signatures", self.verifier.run)
+        self.register_task("announce_inventory", self.announce_inventory, interval=0.1, delay=0.1)
+        self.register_task("retry_requests", self.retry_requests, interval=0.5, delay=0.5)
+
+    async def unload(self) -> None:
+        """ Stop the signature workers together with the community. """
+        self.apply_trigger.cancel()
+        self.verifier.shutdown()
+        await super().unload()
 
     def serialize_transaction(self, tx: Transaction) -> bytes:
         """ Serialize transaction to bytes for storage or transmission. """
-        return json.dumps(tx.__dict__, sort_keys=True).encode()
+        return tx.encode()
 
     def deserialize_transaction(self, data: bytes) -> Transaction:
         """ Deserialize bytes back into Transaction object. """
-        return Transaction(**json.loads(data))
+        return Transaction.decode(data)
 
     def node_id_from_peer(self, peer: Peer) -> int:
         """ Extract node ID from a peer (placeholder implementation). """
         return int.from_bytes(peer.public_key.key_to_bin()[:4], byteorder="big")
 
     def generate_tx_id(self, tx: Transaction):
-        """ Generate a unique ID for a transaction based on its attributes. """
-        return hash((tx.sender, tx.receiver, tx.amount, tx.nonce, tx.ts))
+        """ Generate a unique ID for a transaction from its canonical encoding. """
+        return tx.digest()
 
     def check_transactions(self) -> None:
         """ Process pending transactions and update balances. """
-        for tx in self.pending_txs:
-            if self.balances[tx.sender] - tx.amount >= 0:
-                self.balances[tx.sender] -= tx.amount
+        blocked = set()
+        applied = 0
+        for sender in self.pending_txs.senders():
+            for tx in self.pending_txs.queue(sender):
+                if tx.nonce <= self.nonces[sender]:
+                    # Replay of a transaction that was already applied
+                    self.pending_txs.remove(tx)
+                    continue
+                if tx.nonce != self.nonces[sender] + 1 or self.balances[sender] < tx.amount:
+                    # A nonce is missing or the balance is short; the later nonces wait for this one
+                    blocked.add(sender)
+                    break
+                self.balances[sender] -= tx.amount
                 self.balances[tx.receiver] += tx.amount
+                self.nonces[sender] = tx.nonce
                 self.pending_txs.remove(tx)
                 self.finalized_txs.append(tx)
-                self.merkle_tree.add_leaf(self.serialize_transaction(tx).decode())
+                self.merkle_tree.add_leaf(tx.digest(), do_hash=False)
+                applied += 1
 
         self.executed_checks += 1
+        if blocked and applied:
+            # Senders blocked in this batch may have been paid by a later transaction of it
+            self.apply_trigger.notify()
+
+    def send_batch(self, peer: Peer, signed_txs) -> None:
+        """ Send the coalesced transactions for one peer as a single batch. """
+        self.ez_send(peer, TransactionBatch(signed_txs))
+
+    @lazy_wrapper(TransactionBatch)
+    async def on_transaction_batch(self, peer: Peer, payload: TransactionBatch) -> None:
+        """ Handle every transaction of a batch like a single incoming transaction. """
+        await asyncio.gather(*(self.process_transaction(peer, signed_tx) for signed_tx in payload.transactions))
 
     @lazy_wrapper(SignedTransaction)
     async def on_transaction(self, peer: Peer, payload: SignedTransaction) -> None:
         """ Handle incoming signed transactions. """
+        await self.process_transaction(peer, payload)
+
+    async def process_transaction(self, peer: Peer, payload: SignedTransaction) -> None:
+        """ Deduplicate, verify and relay one signed transaction. """
         tx: Transaction = payload.transaction
 
-        if self.generate_tx_id(tx) in self.saved_txs_hashes:
+        tx_id = self.generate_tx_id(tx)
+        if tx_id in self.seen_txs:
             print(f"Transaction {tx.nonce} already received")
             return
 
-        self.saved_txs_hashes[self.generate_tx_id(tx)] = True
-        print(self.saved_txs_hashes)
+        self.seen_txs.add(tx_id)
+        self.gossip.on_received(tx_id)
+        print(f"Received transaction {tx.nonce} from {tx.sender}")
+
+        # The seen window forgets ids after a while, the applied nonces do not
+        if tx.nonce <= self.nonces[tx.sender]:
+            print(f"Transaction {tx.nonce} from {tx.sender} was already applied")
+            return
 
-        # Verify the signature
+        # Verify the signature on the verifier's worker pool
         try:
-            valid_signature = self.crypto.is_valid_signature(
-                self.crypto.key_from_public_bin(b64decode(payload.public_key)),
+            valid_signature = await self.verifier.verify(
+                b64decode(payload.public_key),
                 self.serialize_transaction(tx),
                 b64decode(payload.signature),
             )
@@ -150,11 +167,47 @@ class ValidatorCommunity(Community):
 
         print(f"Valid transaction {tx.nonce} from {tx.sender}")
 
-        self.pending_txs.append(tx)
-
-        # Gossip to other nodes
-        for peer in self.get_peers():
-            self.ez_send(peer, payload)
+        if not self.pending_txs.add(tx):
+            print(f"Transaction {tx.nonce} from {tx.sender} not added to the mempool")
+            return
+        self.apply_trigger.notify()
+
+        # Announce to other nodes; those that lack the transaction request its body
+        self.relay_transaction(peer, payload)
+
+    def relay_transaction(self, source: Peer, payload: SignedTransaction) -> None:
+        """ Keep the body for requests and announce its id to the other peers. """
+        tx_id = self.generate_tx_id(payload.transaction)
+        self.known_txs[tx_id] = payload
+        if len(self.known_txs) > self.max_known_txs:
+            self.known_txs.popitem(last=False)
+        self.gossip.announce(tx_id, self.get_peers(), source)
+
+    def announce_inventory(self) -> None:
+        """ Send the queued announcements in batches. """
+        for peer, tx_ids in self.gossip.take_announcements():
+            self.ez_send(peer, TransactionInventory(pack_ids(tx_ids)))
+
+    def retry_requests(self) -> None:
+        """ Ask other announcers for bodies that did not arrive in time. """
+        for peer, tx_ids in self.gossip.retry_expired():
+            self.ez_send(peer, TransactionRequest(pack_ids(tx_ids)))
+
+    @lazy_wrapper(TransactionInventory)
+    def on_inventory(self, peer: Peer, payload: TransactionInventory) -> None:
+        """ Request the announced transactions we have not seen yet. """
+        missing = [tx_id for tx_id in unpack_ids(payload.tx_ids) if tx_id not in self.seen_txs]
+        request = self.gossip.on_announced(peer, missing)
+        if request:
+            self.ez_send(peer, TransactionRequest(pack_ids(request)))
+
+    @lazy_wrapper(TransactionRequest)
+    def on_transaction_request(self, peer: Peer, payload: TransactionRequest) -> None:
+        """ Send the bodies of requested transactions that we still hold. """
+        for tx_id in unpack_ids(payload.tx_ids):
+            signed_tx = self.known_txs.get(tx_id)
+            if signed_tx is not None:
+                self.coalescer.add(peer, signed_tx)
 
 async def start_communities() -> None:
     """ Initialize IPv8 and start the ValidatorCommunity. """
@@ -173,4 +226,5 @@ async def start_communities() -> None:
     ).start()
     await run_forever()
 
-run(start_communities())
+if __name__ == "__main__":
+    run(start_communities())
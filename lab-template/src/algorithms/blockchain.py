@@ -8,6 +8,9 @@ from dataclasses import dataclass
 from ipv8.types import Peer
 
 from da_types import Blockchain, message_wrapper
+from algorithms.mining.mempool import Mempool
+from algorithms.mining.signature_verifier import SignatureVerifier
+from algorithms.mining.batch_trigger import BatchTrigger
 
 import json
 
@@ -43,9 +46,13 @@ class BlockchainNode(Blockchain):
         self.max_messages = 5
         self.executed_checks = 0
 
-        self.pending_txs = []
+        self.pending_txs = Mempool(max_count=10000)
         self.finalized_txs = []
+        self.finalized_ids = set()
         self.balances = defaultdict(lambda: 1000)
+        self.verifier = SignatureVerifier()
+        # Applies accepted transactions within 5 ms of their arrival
+        self.apply_trigger = BatchTrigger(self.check_transactions, max_delay=0.005, batch_size=256)
 
         self.add_message_handler(SignedTransaction, self.on_transaction)
 
@@ -98,7 +105,8 @@ class BlockchainNode(Blockchain):
                            interval=1)
 
     def start_validator(self):
-        self.register_task("check_txs", self.check_transactions, delay=2, interval=1)
+        self.register_task("verify_signatures", self.verifier.run)
+        self.register_task("finish", self.finish, delay=12)
 
     def stop(self, delay: int = 0):
 
@@ -107,32 +115,46 @@ class BlockchainNode(Blockchain):
             self.event.set()
 
         self.register_anonymous_task('delayed_stop', delayed_stop, delay=delay)
+
+    async def unload(self) -> None:
+        self.apply_trigger.cancel()
+        self.verifier.shutdown()
+        await super().unload()
         
     def check_transactions(self):
-        for tx in self.pending_txs:
-            if self.balances[tx.sender] - tx.amount >= 0:
-                self.balances[tx.sender] -= tx.amount
+        blocked = set()
+        applied = 0
+        for sender in self.pending_txs.senders():
+            for tx in self.pending_txs.queue(sender):
+                if self.balances[sender] - tx.amount < 0:
+                    blocked.add(sender)
+                    break
+                self.balances[sender] -= tx.amount
                 self.balances[tx.receiver] += tx.amount
                 self.pending_txs.remove(tx)
                 self.finalized_txs.append(tx)
+                self.finalized_ids.add((tx.sender, tx.nonce))
+                applied += 1
 
         self.executed_checks += 1
+        if blocked and applied:
+            self.apply_trigger.notify()
 
-        if self.executed_checks > 10:
-            self.cancel_pending_task("check_txs")
-            print(self.balances)
-            self.stop()
+    def finish(self):
+        self.apply_trigger.cancel()
+        self.check_transactions()
+        print(self.balances)
+        self.stop()
 
     @message_wrapper(SignedTransaction)
     async def on_transaction(self, peer: Peer, payload: SignedTransaction) -> None:
         tx: Transaction = payload.transaction 
-        # Verify the signature
+        # Verify the signature on the verifier's worker pool
         try:
-            valid_signature = self.crypto.is_valid_signature(self.crypto.key_from_public_bin(payload.public_key),
-                                                             self.serialize_transaction(tx),
-                                                                payload.signature)
-            
-                                                            
+            valid_signature = await self.verifier.verify(payload.public_key,
+                                                         self.serialize_transaction(tx),
+                                                         payload.signature)
+
             if not valid_signature:
                 print(f"Invalid signature for transaction {tx.nonce} from {tx.sender}")
                 return
@@ -142,9 +164,9 @@ class BlockchainNode(Blockchain):
 
         print(f"Valid transaction {payload.transaction.nonce} from {payload.transaction.sender}")
         # Add to pending transactions
-        if (tx.sender, tx.nonce) not in [(t.sender, t.nonce) for t in self.finalized_txs] and (
-                tx.sender, tx.nonce) not in [(t.sender, t.nonce) for t in self.pending_txs]:
-            self.pending_txs.append(tx)
+        if (tx.sender, tx.nonce) not in self.finalized_ids:
+            self.pending_txs.add(tx)
+            self.apply_trigger.notify()
             
         # Gossip to other nodes
         for peer in [i for i in self.get_peers() if self.node_id_from_peer(i) % 2 == 1]:
@@ -0,0 +1,66 @@
+from array import array
+
+
+class AccountTable:
+    """ Gives every account (a base64 public key) a dense integer id, with balances and nonces in typed arrays.
+
+    Ids are handed out in the order accounts are first seen and never change,
+    so hot loops can look an account up once and then work on ints. Each
+    account costs its name once plus 16 bytes, instead of a dict entry with
+    a boxed int per balance.
+    """
+
+    def __init__(self, initial_balance=1000):
+        self.initial_balance = initial_balance
+        self.ids = {}
+        self.names = []
+        self.balances = array('q')
+        # Highest nonce applied per account; transactions start at nonce 1
+        self.nonces = array('Q')
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def id_of(self, name):
+        """ The id of ``name``, registering it with the initial balance if it is new. """
+        account = self.ids.get(name)
+        if account is None:
+            account = self.ids[name] = len(self.names)
+            self.names.append(name)
+            self.balances.append(self.initial_balance)
+            self.nonces.append(0)
+        return account
+
+    def get(self, name):
+        """ The id of ``name``, or None if it was never seen. """
+        return self.ids.get(name)
+
+    def name_of(self, account):
+        return self.names[account]
+
+    def balance(self, name):
+        account = self.ids.get(name)
+        return self.initial_balance if account is None else self.balances[account]
+
+    def items(self):
+        """ ``(name, balance)`` of every known account. """
+        return zip(self.names, self.balances)
+
+    def state(self):
+        """ ``{name: (balance, nonce)}`` of every known account. """
+        return {name: (balance, nonce) for name, balance, nonce in zip(self.names, self.balances, self.nonces)}
+
+    def restore(self, state):
+        """ Set balances and nonces from a ``state()`` mapping. """
+        for name, (balance, nonce) in state.items():
+            account = self.id_of(name)
+            self.balances[account] = balance
+            self.nonces[account] = nonce
+
+    def update(self, balances):
+        """ Set the balances of a ``{name: balance}`` mapping, e.g. from a snapshot. """
+        for name, balance in balances.items():
+            self.balances[self.id_of(name)] = balance
@@ -0,0 +1,44 @@
+import asyncio
+
+
+class BatchTrigger:
+    """ Runs ``apply`` shortly after work arrives, instead of on a fixed timer.
+
+    ``notify`` is called for every arrival. The first arrival schedules
+    ``apply`` ``max_delay`` seconds later, so arrivals close together are
+    applied as one micro-batch. Once ``batch_size`` arrivals are waiting,
+    ``apply`` runs on the next loop iteration, so under load batches are
+    drained back to back. An idle node schedules nothing.
+    """
+
+    def __init__(self, apply, max_delay=0.005, batch_size=256):
+        self.apply = apply
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self.pending = 0
+        self.timer = None
+        self.immediate = False
+
+    def notify(self, count=1):
+        self.pending += count
+        loop = asyncio.get_running_loop()
+        if self.pending >= self.batch_size:
+            if not self.immediate:
+                if self.timer is not None:
+                    self.timer.cancel()
+                self.timer = loop.call_soon(self.run)
+                self.immediate = True
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_delay, self.run)
+
+    def run(self):
+        self.timer = None
+        self.immediate = False
+        self.pending = 0
+        self.apply()
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.immediate = False
@@ -1,14 +1,18 @@
 from dataclasses import dataclass
-from hashlib import sha256
+from typing import List
 import json
+import struct
 import time
-import asyncio
 from ipv8.messaging.payload_dataclass import overwrite_dataclass
 from merkle_tree import MerkleTree
-from collections import defaultdict
-from ipv8.community import Community, CommunitySettings
-from ipv8.lazy_community import lazy_wrapper
-from ipv8.types import Peer
+from transaction import Transaction, SignedTransaction
+from mining_engine import MiningEngine
+from blockchain import BlockIndex
+from block_store import BlockStore
+from ledger import Ledger
+from snapshot import Snapshot
+from proof_of_work import HeaderHasher, difficulty_to_target, header_prefix, header_work, meets_target
+from collections import OrderedDict
 
 
 class bcolors:
@@ -25,65 +29,217 @@ class bcolors:
 # Custom dataclass implementation
 dataclass = overwrite_dataclass(dataclass)
 
-@dataclass
-class Transaction:
-    """ Represents a basic transaction. """
-    sender: str
-    receiver: str
-    amount: int
-    nonce: int = 1
-    ts: int = 0
-
-@dataclass
-class SignedTransaction:
-    """ Represents a signed transaction including a signature and public key. """
-    transaction: Transaction
-    signature: str
-    public_key: str
-
-@dataclass
+@dataclass(msg_id=9)
 class BlockMessage:
-    """ Represents a block message. """
+    """ Represents a block header; the body is fetched separately with BlockBodyRequest. """
     timestamp: int
     difficulty: int
     nonce: int
     prev_hash: str
     merkle_root: str
-    coinbase_tx: str
 
-class Block:
-    """ Represents a block of transactions. """
-    def __init__(self, timestamp, difficulty, nonce, prev_hash, merkle_root, coinbase_tx):
+@dataclass(msg_id=6)
+class CompactBlock:
+    """ Block header plus the salted short ids of its transactions, see compact_block.py. """
+    header: BlockMessage
+    salt: bytes
+    short_ids: bytes
+
+@dataclass(msg_id=7)
+class BlockTransactionsRequest:
+    """ Asks for the transactions at the packed indexes of the block with this hash. """
+    block_hash: str
+    indexes: bytes
+
+@dataclass(msg_id=8)
+class BlockTransactions:
+    """ The requested transactions of a compact block, in the order of ``indexes``. """
+    block_hash: str
+    indexes: bytes
+    transactions: List[SignedTransaction]
+
+@dataclass(msg_id=10)
+class BlockBodyRequest:
+    """ Asks for the transactions of the block with this hash. """
+    block_hash: str
+
+@dataclass(msg_id=11)
+class BlockBody:
+    """ All transactions of a block, in block order. """
+    block_hash: str
+    transactions: List[SignedTransaction]
+
+# BlockBody and BlockTransactions carry a whole body in one UDP datagram of at most 64 KiB;
+# the rest is left for the block hash, the indexes and the per-transaction message overhead
+MAX_BODY_BYTES = 56 * 1024
+
+@dataclass(msg_id=12)
+class ChainStatus:
+    """ Height and tip of the sender's chain, sent periodically so peers know whom to sync from. """
+    height: int
+    tip_hash: str
+
+@dataclass(msg_id=13)
+class GetHeaders:
+    """ Asks for the headers after the first block of the locator (packed 32-byte hashes) the peer knows. """
+    locator: bytes
+
+@dataclass(msg_id=14)
+class Headers:
+    """ Consecutive block headers, oldest first. """
+    headers: List[BlockMessage]
+
+# Fixed so that every node starts from the same genesis block
+GENESIS_TIMESTAMP = 1704067200
+
+# Stored block layout: timestamp, difficulty, nonce, prev_hash, merkle_root and the
+# transaction count, then every signed transaction's canonical encoding with a length prefix
+STORED_HEADER = struct.Struct('>QIQ32s32sI')
+STORED_TX_LENGTH = struct.Struct('>H')
+
+def encode_block(block):
+    header = block.header
+    parts = [STORED_HEADER.pack(header.timestamp, header.difficulty, header.nonce, bytes.fromhex(header.prev_hash),
+                                bytes.fromhex(header.merkle_root or '00' * 32), len(block.transactions))]
+    for tx in block.transactions:
+        data = tx.encode()
+        parts.append(STORED_TX_LENGTH.pack(len(data)) + data)
+    return b''.join(parts)
+
+def decode_block(data):
+    timestamp, difficulty, nonce, prev_hash, merkle_root, count = STORED_HEADER.unpack_from(data)
+    offset = STORED_HEADER.size
+    transactions = []
+    for _ in range(count):
+        (length,) = STORED_TX_LENGTH.unpack_from(data, offset)
+        offset += STORED_TX_LENGTH.size
+        transactions.append(SignedTransaction.decode(data[offset:offset + length]))
+        offset += length
+    return Block(BlockHeader(timestamp, difficulty, nonce, prev_hash.hex(), merkle_root.hex()), transactions)
+
+def transactions_payload(transactions):
+    """ The JSON body of a block, as printed and stored. """
+    return json.dumps([tx.to_dict() for tx in transactions])
+
+class BlockHeader:
+    """ The proof-of-work part of a block; it commits to the transactions only through merkle_root. """
+    def __init__(self, timestamp, difficulty, nonce, prev_hash, merkle_root):
         self.timestamp = timestamp
-        self.difficulty = '0' * difficulty
+        self.difficulty = difficulty
         self.nonce = nonce
         self.prev_hash = prev_hash
         self.merkle_root = merkle_root
-        self.coinbase_tx = coinbase_tx
-        self.hash = self.calculate_hash()
-    
+        # Computed on first use, so received headers can be hashed by the validation workers
+        self._hash = None
+
+    @property
+    def hash(self):
+        if self._hash is None:
+            self._hash = self.calculate_hash()
+        return self._hash
+
+    @hash.setter
+    def hash(self, value):
+        self._hash = value
+
+    @classmethod
+    def from_message(cls, payload):
+        return cls(payload.timestamp, payload.difficulty, payload.nonce, payload.prev_hash, payload.merkle_root)
+
+    def to_message(self):
+        return BlockMessage(self.timestamp, self.difficulty, self.nonce, self.prev_hash, self.merkle_root)
+
+    def header_prefix(self):
+        """ Binary header without the nonce, see proof_of_work.HEADER_PREFIX. """
+        return header_prefix(self.timestamp, self.difficulty, self.prev_hash, self.merkle_root)
+
     def calculate_hash(self):
-        block_string = f'{self.timestamp}{self.difficulty}{self.nonce}{self.prev_hash}{self.merkle_root}{self.coinbase_tx}'
-        return sha256(block_string.encode()).hexdigest()
+        return HeaderHasher(self.header_prefix()).hexdigest(self.nonce)
+
+    def has_valid_proof(self):
+        return meets_target(bytes.fromhex(self.hash), difficulty_to_target(self.difficulty))
+
+class Block:
+    """ Represents a block: a header and its body, the list of signed transactions. """
+    def __init__(self, header, transactions):
+        self.header = header
+        self.transactions = transactions
+
+    @property
+    def hash(self):
+        return self.header.hash
+
+    @property
+    def prev_hash(self):
+        return self.header.prev_hash
+
+    @property
+    def merkle_root(self):
+        return self.header.merkle_root
 
 class Blockchain:
     """ Manages the blockchain and its operations. """
-    def __init__(self, node_id, difficulty_target):
+    def __init__(self, node_id, difficulty_target, mining_workers=None, cached_trees=16, undo_depth=100,
+                 store_dir=None, snapshot=None):
         self.node_id = node_id
         self.difficulty_target = difficulty_target
-        self.chain = [self.create_genesis_block()]
+        self.cached_trees = cached_trees
+        self.merkle_trees = OrderedDict()
+        genesis = self.create_genesis_block()
+        # The active chain, on disk; without store_dir it lives in temporary files
+        self.chain = BlockStore(store_dir, encode_block, decode_block)
+        if len(self.chain) == 0 or self.chain.hash_at(0) != genesis.hash:
+            self.chain.truncate(0)
+            self.chain.append(genesis, header_work(genesis.header.difficulty))
+        # Recent blocks by hash, including side branches; bodies of stored blocks stay on disk
+        tip_height = self.height()
+        self.index = BlockIndex(self.chain)
+        # Balances at the tip; reorgs deeper than undo_depth are refused
+        self.ledger = Ledger(undo_depth)
+        replay_from = 0
+        if snapshot is not None and snapshot.height <= tip_height and self.chain.hash_at(snapshot.height) == snapshot.tip_hash:
+            # Only the blocks after the snapshot have to be replayed
+            self.ledger.accounts.update(snapshot.balances)
+            replay_from = snapshot.height + 1
+        for height in range(replay_from, tip_height + 1):
+            self.ledger.apply_block(self.chain[height])
         self.active_mining = False
+        self.mining_engine = MiningEngine(mining_workers)
 
-    def create_merkle_root(self, transactions):
-        """ Create a Merkle root from a list of signed transactions. """
+    def build_merkle_tree(self, transactions):
+        """ A Merkle tree over a list of signed transactions, using their ids as leaves. """
         tree = MerkleTree()
-        for signed_tx in transactions:
-            tx_string = json.dumps(signed_tx.__dict__, default=lambda o: o.__dict__)
-            tree.add_leaf(tx_string)
-        return tree.get_root()
+        for tx in transactions:
+            tree.add_leaf(tx.digest(), do_hash=False)
+        return tree
+
+    def create_merkle_root(self, transactions):
+        """ Create a Merkle root from a list of signed transactions, using their ids as leaves. """
+        return self.build_merkle_tree(transactions).get_root()
+
+    def transaction_proof(self, block, index):
+        """ Inclusion proof for the index-th transaction of a block, or None if the transactions do not match its root.
+
+        The levels of recently proven blocks of the chain are kept around, so
+        further proofs for them skip rebuilding the tree. Trees of templates
+        and side branches are not kept.
+        """
+        tree = self.merkle_trees.get(block.merkle_root)
+        if tree is not None:
+            self.merkle_trees.move_to_end(block.merkle_root)
+            return tree.proof(index)
+
+        tree = self.build_merkle_tree(block.transactions)
+        if tree.get_root() != block.merkle_root:
+            return None
+        if self.chain.height_of(block.hash) is not None:
+            self.merkle_trees[block.merkle_root] = tree
+            if len(self.merkle_trees) > self.cached_trees:
+                self.merkle_trees.popitem(last=False)
+        return tree.proof(index)
 
     def create_genesis_block(self):
-        timestamp = int(time.time())
+        timestamp = GENESIS_TIMESTAMP
         difficulty = self.difficulty_target
         nonce = 0
         prev_hash = '0' * 64
@@ -94,114 +250,228 @@ class Blockchain:
         )
         transactions = [coinbase_tx]
         merkle_root = self.create_merkle_root(transactions)
-        return Block(timestamp, difficulty, nonce, prev_hash, merkle_root, json.dumps(coinbase_tx.__dict__, default=lambda o: o.__dict__))
+        return Block(BlockHeader(timestamp, difficulty, nonce, prev_hash, merkle_root), transactions)
 
-    async def create_new_block(self, transactions):
+    def block_template(self, transactions):
+        """ An unmined block with ``transactions`` on top of the current tip. """
         timestamp = int(time.time())
         nonce = 0
         prev_hash = self.chain[-1].hash
         merkle_root = self.create_merkle_root(transactions)
-        
-        # Convert transactions to a JSON serializable format
-        transactions_json = [tx.__dict__ for tx in transactions]
-        
-        new_block = Block(timestamp, self.difficulty_target, nonce, prev_hash, merkle_root, json.dumps(transactions_json))
-        
+        return Block(BlockHeader(timestamp, self.difficulty_target, nonce, prev_hash, merkle_root), transactions)
+
+    async def create_new_block(self, transactions):
+        new_block = self.block_template(transactions)
         await self.mine_block(new_block)
         return new_block
 
-        
+    def height(self):
+        return len(self.chain) - 1
 
+    def snapshot(self):
+        """ Balances as of the oldest block the ledger can still roll back to; cheap enough to take on the event loop.
 
-    async def add_block(self, transactions):
-        if len(transactions) % 3 != 0:
-            raise ValueError("The number of transactions must be a multiple of 3.")
-        
-        for i in range(0, len(transactions), 3):
-            batch = transactions[i:i+3]
+        A restart replays the blocks after it, which rebuilds their undo records,
+        so reorgs below the restart tip stay possible.
+        """
+        depth = min(len(self.ledger.undo), self.height())
+        height = self.height() - depth
+        return Snapshot(height, self.chain.hash_at(height), self.ledger.balances_before(depth))
+
+    def get_block(self, block_hash):
+        """ A block on a side branch in the index or on the stored chain, or None. """
+        entry = self.index.get(block_hash)
+        if entry is not None and entry.block is not None:
+            return entry.block
+        height = self.chain.height_of(block_hash)
+        return self.chain[height] if height is not None else None
+
+    def height_of(self, block_hash):
+        entry = self.index.get(block_hash)
+        return entry.height if entry else self.chain.height_of(block_hash)
+
+    def locator(self):
+        """ Hashes of the last ten blocks, then of blocks exponentially further back, ending with genesis. """
+        hashes = []
+        height, step = self.height(), 1
+        while height > 0:
+            hashes.append(self.chain.hash_at(height))
+            if len(hashes) >= 10:
+                step *= 2
+            height -= step
+        hashes.append(self.chain.hash_at(0))
+        return hashes
+
+    def headers_after(self, locator, max_count):
+        """ Up to ``max_count`` headers following the highest locator block that is in our chain. """
+        heights = (self.chain.height_of(block_hash) for block_hash in locator)
+        fork_height = next((height for height in heights if height is not None), 0)
+        return [block.header for block in self.chain[fork_height + 1:fork_height + 1 + max_count]]
+
+    def connect_blocks(self, blocks):
+        """ Index downloaded blocks, whose bodies were checked already, and switch to them if they have more work.
+
+        Returns the ``(connected, disconnected)`` blocks of activate_best_chain,
+        or None if a block has an unknown parent.
+        """
+        for block in blocks:
+            if self.index.add(block, validated=True) is None:
+                return None
+        return self.activate_best_chain()
+
+    def activate_best_chain(self):
+        """ Make the branch with the most work the active chain.
+
+        Returns ``(connected, disconnected)``: the blocks that joined the active
+        chain and those that left it, oldest first; both are empty if the tip
+        did not change. Only the blocks after the fork point whose bodies were
+        not checked yet are validated.
+        """
+        tip = self.index.get(self.chain.hash_at(self.height()))
+        while self.index.best is not tip:
+            best = self.index.best
+            fork = self.index.fork_point(tip, best)
+            branch = self.index.branch(fork, best)
+            invalid = next((entry for entry in branch if not self.validate_entry(entry)), None)
+            if invalid is not None:
+                self.index.remove(invalid)
+                continue
+
+            disconnected = self.chain[fork.height + 1:]
+            if not self.ledger.can_rollback(disconnected):
+                print(f"{bcolors.ERROR}Refusing to reorganize {len(disconnected)} blocks, beyond the undo depth")
+                self.index.remove(branch[0])
+                continue
+
+            if disconnected:
+                print(f"{bcolors.WARNING}Reorganizing {len(disconnected)} blocks at height {fork.height}")
+            for block in reversed(disconnected):
+                self.ledger.rollback(block)
+            # The store is only changed once the whole branch applied to the ledger
+            applied = []
+            try:
+                for entry in branch:
+                    self.ledger.apply_block(entry.block)
+                    applied.append(entry)
+            except ValueError as e:
+                print(f"{bcolors.ERROR}{e}")
+                for entry in reversed(applied):
+                    self.ledger.rollback(entry.block)
+                for block in disconnected:
+                    self.ledger.apply_block(block)
+                self.index.remove(branch[len(applied)])
+                continue
+
+            for block in disconnected:
+                # Off the stored chain now, so the index keeps the body
+                self.index.get(block.hash).block = block
+            self.chain.truncate(fork.height + 1)
+            connected = [entry.block for entry in branch]
+            for entry in branch:
+                self.chain.append(entry.block, entry.chain_work)
+                entry.block = None
+            self.chain.flush()
+            self.index.prune(self.ledger.undo_depth)
+            return connected, disconnected
+        return [], []
+
+    def validate_entry(self, entry):
+        if not entry.validated:
+            block = entry.block
+            entry.validated = self.create_merkle_root(block.transactions) == block.merkle_root
+            if not entry.validated:
+                print(f"{bcolors.ERROR}Block {block.hash} does not match its Merkle root")
+        return entry.validated
+
+    def check_header(self, header):
+        """ Proof of work can be checked before the body is known. """
+        return header.difficulty == self.difficulty_target and header.has_valid_proof()
+
+    def accept_block(self, block):
+        """ Index a block from a peer and switch to its branch if that has the most work.
+
+        The body is only checked once its branch is activated. Returns the
+        ``(connected, disconnected)`` blocks of activate_best_chain, or None if
+        the block was rejected.
+        """
+        if not self.check_header(block.header):
+            print(f"{bcolors.ERROR}Block {block.hash} has an invalid proof of work")
+            return None
+        if self.index.add(block) is None:
+            print(f"{bcolors.WARNING}Block {block.hash} has an unknown parent")
+            return None
+        update = self.activate_best_chain()
+        return update if block.hash in self.index else None
+
+    async def add_block(self, transactions, max_count=None):
+        """ Mine ``transactions`` into blocks of at most ``max_count`` each, or into one block. """
+        max_count = max_count or len(transactions) or 1
+        new_block = None
+        for i in range(0, len(transactions), max_count):
+            batch = transactions[i:i+max_count]
             new_block = await self.create_new_block(batch)
-            self.chain.append(new_block)
         return new_block
     
     def compute_hash(self, block, nonce):
-        block_string = f'{block.timestamp}{block.difficulty}{nonce}{block.prev_hash}{block.merkle_root}{block.coinbase_tx}'
-        return sha256(block_string.encode()).hexdigest()
-
-    def compute_hash(self, block, nonce):
-        block_string = f'{block.timestamp}{block.difficulty}{nonce}{block.prev_hash}{block.merkle_root}{block.coinbase_tx}'
-        return sha256(block_string.encode()).hexdigest()
+        return HeaderHasher(block.header.header_prefix()).hexdigest(nonce)
 
     async def mine_block(self, block):
+        """ Search a nonce for ``block`` and add it; returns whether it became the tip. """
         print(f"Starting mining block {block}")
         
         # Start a timer
         start_time = time.time()
-        start_time2 = time.time()
-        hashes_computed = 0
-        current_nonce = 0
         
-        target = '0' * self.difficulty_target
+        header = block.header
+        target = difficulty_to_target(header.difficulty)
+        
+        # Only the nonce changes, so the header prefix is hashed once per block
+        hasher = HeaderHasher(header.header_prefix())
+        
+        self.active_mining = True
+        try:
+            solution = await self.mining_engine.mine(hasher, target)
+        finally:
+            self.active_mining = False
+        
+        print(f"Time elapsed: {time.time() - start_time:.2f} seconds")
+        for worker_id, rate in sorted(self.mining_engine.hash_rates.items()):
+            print(f"Worker {worker_id}: {rate:.0f} hashes/sec")
+        print(f"Total: {self.mining_engine.total_hash_rate():.0f} hashes/sec")
+        
+        if solution is None:
+            print(f"{bcolors.WARNING}Mining of block {block} was stopped")
+            return False
+        
+        current_nonce, hash_result = solution
+        
+        # edit the block's nonce and hash
+        header.nonce = current_nonce
+        header.hash = hash_result
+        
+        # decode the block and print it
+        print(
+            f'{bcolors.OKBLOCK}------------------------------------\n'
+            f"{bcolors.OKBLOCK}Block mined by miner {self.node_id} with hash {block.hash}\n"
+            f'''
+            {bcolors.OKBLOCK}New Block:\n
+            {bcolors.OKBLOCK}Timestamp: {header.timestamp}\n
+            {bcolors.OKBLOCK}Difficulty: {header.difficulty}\n
+            {bcolors.OKBLOCK}Nonce: {header.nonce}\n
+            {bcolors.OKBLOCK}Previous Hash: {header.prev_hash}\n
+            {bcolors.OKBLOCK}Merkle Root: {header.merkle_root}\n
+            {bcolors.OKBLOCK}Transactions: {transactions_payload(block.transactions)}\n
+            {bcolors.OKBLOCK}Hash: {block.hash}\n'''
+            f'{bcolors.OKBLOCK}------------------------------------\n'
+        )        
+
+        # Add the block to the chain, or keep it as a side branch if the tip moved meanwhile
+        self.index.add(block, validated=True)
+        connected, _ = self.activate_best_chain()
+        if not connected:
+            print(f"{bcolors.WARNING}Chain tip moved while mining, block kept as a side branch")
         
-        while True:
-            self.active_mining = True
-            
-            
-            # Every 2 seconds, print the time elapsed and the number of hashes computed
-            if time.time() - start_time > 2:
-                print(f"Hashes computed: {hashes_computed}")
-                # print the time since start_time was defined and formatted in seconds
-                print(f"Time elapsed: {time.time() - start_time2:.2f} seconds")
-                
-                
-                start_time = time.time()
-                hashes_computed = 0
-                
-            
-            hash_result = self.compute_hash(block, current_nonce)
-            
-            if hash_result.startswith(target):
-                block.nonce = current_nonce
-                block.hash = hash_result
-                print(f"Block mined by miner {self.node_id} with hash {block.hash}")
-                
-                
-                # edit the block's nonce and hash
-                block.nonce = current_nonce
-                block.hash = hash_result
-                block.difficulty = self.difficulty_target
-                
-              
-                
-                # decode the block and print it
-                print(
-                    f'{bcolors.OKBLOCK}------------------------------------\n'
-                    f"{bcolors.OKBLOCK}Block mined by miner {self.node_id} with hash {block.hash}\n"
-                    f'''
-                    {bcolors.OKBLOCK}New Block:\n
-                    {bcolors.OKBLOCK}Timestamp: {block.timestamp}\n
-                    {bcolors.OKBLOCK}Difficulty: {block.difficulty}\n
-                    {bcolors.OKBLOCK}Nonce: {block.nonce}\n
-                    {bcolors.OKBLOCK}Previous Hash: {block.prev_hash}\n
-                    {bcolors.OKBLOCK}Merkle Root: {block.merkle_root}\n
-                    {bcolors.OKBLOCK}Transaction: {block.coinbase_tx}\n
-                    {bcolors.OKBLOCK}Hash: {block.hash}\n'''
-                    f'{bcolors.OKBLOCK}------------------------------------\n'
-                )        
-                
-
-                # Add the block to the chain
-                self.chain.append(block)
-                
-                # Print all the blocks
-                for blk in self.chain:
-                    print(blk)
-                
-                self.active_mining = False
-                return
-            
-            current_nonce += 1
-            hashes_computed += 1
-            await asyncio.sleep(0)  # Yield control to allow other tasks to run
+        return self.chain[-1].hash == block.hash
 
 
 
@@ -0,0 +1,50 @@
+import heapq
+
+
+class BlockAssembler:
+    """ Picks the transactions of the next block from a TransactionStore, within a count and byte budget.
+
+    Transactions carry no fee, so they are ranked by age: the oldest timestamp
+    goes first, and ties go to the one that entered the store first. The
+    greedy pass only looks at the lowest pending nonce of each sender, so a
+    sender's transactions always enter the block in nonce order. If that
+    transaction does not fit in the remaining bytes, the rest of the sender's
+    queue is skipped too. Smaller transactions of other senders can still
+    fill the block.
+
+    The block takes as much of the backlog as the budget allows, so one proof
+    of work confirms up to ``max_count`` transactions when there are that many.
+    """
+
+    def __init__(self, max_count=2000, max_bytes=512 * 1024, min_count=1):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.min_count = min_count
+
+    def select(self, store):
+        """ Row indexes of ``store`` for the next block in block order, or [] if fewer than ``min_count`` qualify. """
+        queues = {}
+        for index, (sender, nonce) in enumerate(zip(store.senders, store.nonces)):
+            queues.setdefault(sender, []).append((nonce, index))
+        heads = []
+        for sender, queue in queues.items():
+            queue.sort(reverse=True)
+            nonce, index = queue.pop()
+            heads.append((store.timestamps[index], index, sender))
+        heapq.heapify(heads)
+
+        selected = []
+        budget = self.max_bytes
+        while heads and len(selected) < self.max_count:
+            _, index, sender = heapq.heappop(heads)
+            size = store.size(index)
+            if size > budget:
+                continue
+            budget -= size
+            selected.append(index)
+            queue = queues[sender]
+            if queue:
+                _, index = queue.pop()
+                heapq.heappush(heads, (store.timestamps[index], index, sender))
+
+        return selected if len(selected) >= self.min_count else []
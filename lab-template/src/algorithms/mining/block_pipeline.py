@@ -0,0 +1,66 @@
+import asyncio
+
+
+class BlockPipeline:
+    """ Produces blocks in the background: build a template, mine it, publish it.
+
+    Message handlers only call ``update`` when the mempool or the chain tip
+    changes; they never wait for mining. ``run`` builds a template from
+    ``select_transactions()`` whenever something changed and mines it. A
+    template that no longer extends the tip is abandoned at once, while
+    transactions that arrive during mining go into the next template.
+    Mined blocks that became the tip are handed to ``publish``. An error while
+    building, mining or publishing a block is logged and the block is tried
+    again after ``retry_delay`` seconds, so one failure does not stop mining.
+    """
+
+    def __init__(self, blockchain, select_transactions, publish, min_transactions=1, retry_delay=1.0):
+        self.blockchain = blockchain
+        self.select_transactions = select_transactions
+        self.publish = publish
+        self.min_transactions = min_transactions
+        self.retry_delay = retry_delay
+        self.changed = asyncio.Event()
+        # The template being mined, if any
+        self.mining = None
+        self.blocks_mined = 0
+
+    def update(self):
+        """ Note a change of the mempool or the tip; stops mining a template that went stale. """
+        self.changed.set()
+        if self.mining is not None and self.mining.prev_hash != self.blockchain.chain[-1].hash:
+            self.blockchain.mining_engine.stop()
+
+    def build_template(self):
+        transactions = self.select_transactions()
+        if len(transactions) < self.min_transactions:
+            return None
+        return self.blockchain.block_template(transactions)
+
+    async def run(self):
+        """ Mine the newest template whenever there is one; runs until cancelled. """
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+            try:
+                await self.produce_block()
+            except Exception as e:
+                print(f"Block pipeline failed, retrying in {self.retry_delay} s: {e!r}")
+                await asyncio.sleep(self.retry_delay)
+                self.changed.set()
+
+    async def produce_block(self):
+        template = self.build_template()
+        if template is None:
+            return
+
+        self.mining = template
+        try:
+            mined = await self.blockchain.mine_block(template)
+        finally:
+            self.mining = None
+        if mined:
+            self.blocks_mined += 1
+            self.publish(template)
+            # The mempool may hold enough transactions for another block
+            self.changed.set()
@@ -0,0 +1,177 @@
+import mmap
+import os
+import struct
+import tempfile
+from collections import OrderedDict
+
+RECORD_LENGTH = struct.Struct('>I')
+COUNT = struct.Struct('>Q')
+HEIGHT_ENTRY = struct.Struct('>Q32s32s')  # offset in blocks.dat, block hash, cumulative work
+HASHES_HEADER = struct.Struct('>QQ')      # slots, used slots
+HASH_SLOT = struct.Struct('>32sQ')        # block hash, height + 1 (0 marks an empty slot)
+
+
+class BlockStore:
+    """ Append-only file of serialized blocks with memory-mapped indexes by height and by hash.
+
+    ``blocks.dat`` holds length-prefixed records and is only ever appended to.
+    ``heights.idx`` maps each height of the active chain to the offset, hash and
+    cumulative work of its block, and ``hashes.idx`` is an open-addressing table
+    from hash to height. Both indexes have fixed-width entries and are memory
+    mapped, so lookups are O(1) and reopening the store reads nothing else.
+    Cutting the chain back only lowers the count; a hash entry above it is
+    recognised as stale because that height no longer holds the hash.
+
+    The store behaves like a list of blocks, decoded on access, with a small
+    cache of recent ones. Without a directory the files are temporary.
+    """
+
+    def __init__(self, directory, encode, decode, cached_blocks=64, initial_capacity=1024):
+        self.encode = encode
+        self.decode = decode
+        self.cached_blocks = cached_blocks
+        self.cache = OrderedDict()
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self.data = self.open_file(directory, 'blocks.dat')
+        self.data_size = self.data.seek(0, os.SEEK_END)
+        self.heights_file = self.open_file(directory, 'heights.idx')
+        self.heights = self.map_file(self.heights_file, COUNT.size + initial_capacity * HEIGHT_ENTRY.size)
+        self.hashes_file = self.open_file(directory, 'hashes.idx')
+        self.hashes = self.map_file(self.hashes_file, HASHES_HEADER.size + 2 * initial_capacity * HASH_SLOT.size)
+        if HASHES_HEADER.unpack_from(self.hashes)[0] == 0:
+            self.rebuild_hashes(2 * initial_capacity)
+
+    @staticmethod
+    def open_file(directory, name):
+        if directory is None:
+            return tempfile.TemporaryFile()
+        path = os.path.join(directory, name)
+        return open(path, 'r+b' if os.path.exists(path) else 'w+b')
+
+    @staticmethod
+    def map_file(file, min_size):
+        if file.seek(0, os.SEEK_END) < min_size:
+            file.truncate(min_size)
+        return mmap.mmap(file.fileno(), 0)
+
+    def __len__(self):
+        return COUNT.unpack_from(self.heights)[0]
+
+    def __getitem__(self, height):
+        if isinstance(height, slice):
+            return [self[h] for h in range(*height.indices(len(self)))]
+        if height < 0:
+            height += len(self)
+        if not 0 <= height < len(self):
+            raise IndexError(f"No block at height {height}")
+
+        offset, key, _ = self.entry(height)
+        block = self.cache.get(key)
+        if block is not None:
+            self.cache.move_to_end(key)
+            return block
+        fileno = self.data.fileno()
+        (length,) = RECORD_LENGTH.unpack(os.pread(fileno, RECORD_LENGTH.size, offset))
+        block = self.decode(os.pread(fileno, length, offset + RECORD_LENGTH.size))
+        self.remember(key, block)
+        return block
+
+    def __iter__(self):
+        for height in range(len(self)):
+            yield self[height]
+
+    def entry(self, height):
+        return HEIGHT_ENTRY.unpack_from(self.heights, COUNT.size + height * HEIGHT_ENTRY.size)
+
+    def hash_at(self, height):
+        return self.entry(height)[1].hex()
+
+    def chain_work(self, height):
+        return int.from_bytes(self.entry(height)[2], 'big')
+
+    def height_of(self, block_hash):
+        key = bytes.fromhex(block_hash)
+        _, height = self.probe(key)
+        if 0 <= height < len(self) and self.entry(height)[1] == key:
+            return height
+        return None
+
+    def append(self, block, chain_work):
+        """ Write a block on top of the chain; it is on disk once flush() returns. """
+        data = self.encode(block)
+        offset = self.data_size
+        self.data.seek(offset)
+        self.data.write(RECORD_LENGTH.pack(len(data)) + data)
+        self.data.flush()
+        self.data_size += RECORD_LENGTH.size + len(data)
+
+        height = len(self)
+        end = COUNT.size + (height + 1) * HEIGHT_ENTRY.size
+        if end > len(self.heights):
+            size = 2 * len(self.heights)
+            self.heights.close()
+            self.heights = self.map_file(self.heights_file, size)
+        key = bytes.fromhex(block.hash)
+        HEIGHT_ENTRY.pack_into(self.heights, end - HEIGHT_ENTRY.size, offset, key, chain_work.to_bytes(32, 'big'))
+        self.index_hash(key, height)
+        # The count goes last, so a torn write leaves the previous chain intact
+        COUNT.pack_into(self.heights, 0, height + 1)
+        self.remember(key, block)
+
+    def truncate(self, length):
+        """ Drop the blocks from height ``length`` up from the chain; their records stay in blocks.dat. """
+        COUNT.pack_into(self.heights, 0, min(length, len(self)))
+
+    def remember(self, key, block):
+        self.cache[key] = block
+        if len(self.cache) > self.cached_blocks:
+            self.cache.popitem(last=False)
+
+    def probe(self, key):
+        """ Offset of the slot holding ``key`` or of the empty slot where it goes, and its height (-1 if empty). """
+        slots, _ = HASHES_HEADER.unpack_from(self.hashes)
+        index = int.from_bytes(key[:8], 'big') & (slots - 1)
+        while True:
+            offset = HASHES_HEADER.size + index * HASH_SLOT.size
+            stored, height = HASH_SLOT.unpack_from(self.hashes, offset)
+            if height == 0 or stored == key:
+                return offset, height - 1
+            index = (index + 1) & (slots - 1)
+
+    def index_hash(self, key, height):
+        slots, used = HASHES_HEADER.unpack_from(self.hashes)
+        if 2 * (used + 1) > slots:
+            self.rebuild_hashes(2 * slots)
+            slots, used = HASHES_HEADER.unpack_from(self.hashes)
+        offset, previous = self.probe(key)
+        if previous < 0:
+            used += 1
+        HASH_SLOT.pack_into(self.hashes, offset, key, height + 1)
+        HASHES_HEADER.pack_into(self.hashes, 0, slots, used)
+
+    def rebuild_hashes(self, slots):
+        """ Re-create the hash table with at least ``slots`` slots from the height index, dropping stale entries. """
+        while slots < 2 * (len(self) + 1):
+            slots *= 2
+        size = HASHES_HEADER.size + slots * HASH_SLOT.size
+        self.hashes.close()
+        self.hashes_file.truncate(0)
+        self.hashes = self.map_file(self.hashes_file, size)
+        HASHES_HEADER.pack_into(self.hashes, 0, slots, 0)
+        for height in range(len(self)):
+            self.index_hash(self.entry(height)[1], height)
+
+    def flush(self):
+        self.data.flush()
+        os.fsync(self.data.fileno())
+        self.heights.flush()
+        self.hashes.flush()
+
+    def close(self):
+        self.flush()
+        self.heights.close()
+        self.hashes.close()
+        for file in (self.data, self.heights_file, self.hashes_file):
+            file.close()
@@ -1,35 +1,136 @@
-class Blockchain:
-    def __init__(self):
-        self.chain = []
-
-    def add_block(self, block):
-        self.chain.append(block)
-
-    def get_last_block(self):
-        return self.chain[-1] if self.chain else None
-
-    def is_valid_chain(self, chain):
-        for i in range(1, len(chain)):
-            current_block = chain[i]
-            previous_block = chain[i - 1]
-            if current_block.previous_block_hash != previous_block.compute_hash():
-                return False
-            if not self.is_valid_proof(current_block):
-                return False
-        return True
-
-    def is_valid_proof(self, block):
-        target_prefix = '0' * block.difficulty_target
-        return block.compute_hash().startswith(target_prefix)
-
-    def resolve_conflicts(self, new_chain):
-        if len(new_chain) > len(self.chain):
-            if self.is_valid_chain(new_chain):
-                self.chain = new_chain
-                return True
-        elif len(new_chain) == len(self.chain):
-            if self.is_valid_chain(new_chain):
-                if new_chain[-1].ts < self.chain[-1].ts:
-                    self.chain = new_chain
-                    return True
-        return False
+from proof_of_work import header_work
+
+
+class BlockIndexEntry:
+    """ A block in the index with its parent, height, the work of the chain ending in it and whether its body was checked.
+
+    ``block`` holds the block only while it is not on the stored chain; once it
+    is stored, the body is read back from the block store when needed.
+    """
+    __slots__ = ('hash', 'parent', 'height', 'chain_work', 'validated', 'sequence', 'block')
+
+    def __init__(self, block_hash, parent, height, chain_work, validated, sequence, block=None):
+        self.hash = block_hash
+        self.parent = parent
+        self.height = height
+        self.chain_work = chain_work
+        self.validated = validated
+        self.sequence = sequence
+        self.block = block
+
+
+class BlockIndex:
+    """ Known blocks by hash, including side branches, with the best tip by cumulative work.
+
+    Adding a block updates the best tip in O(1). Switching to another branch only
+    walks back to the fork point, so a reorg costs O(depth) rather than O(length).
+    Ties in work keep the block that was seen first.
+
+    The index starts at the tip of the block store. Stored ancestors are
+    loaded from the store's height index when a block forks off below the
+    lowest loaded one, and ``prune`` forgets entries deep below the tip again,
+    so the index stays small however long the chain gets.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.entries = {}
+        self.sequence = 0
+        tip_height = len(store) - 1
+        # The lowest loaded block of the stored chain
+        self.base = self.best = self.insert_stored(tip_height)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, block_hash):
+        return self.entries.get(block_hash)
+
+    def add(self, block, validated=False):
+        """ Index a block whose parent is known; returns its entry, or None for an orphan. """
+        entry = self.entries.get(block.hash)
+        if entry is not None:
+            entry.validated = entry.validated or validated
+            return entry
+        parent = self.entries.get(block.prev_hash) or self.load(block.prev_hash)
+        if parent is None:
+            return None
+
+        chain_work = parent.chain_work + header_work(block.header.difficulty)
+        entry = self.insert(block.hash, parent, parent.height + 1, chain_work, validated, block)
+        if entry.chain_work > self.best.chain_work:
+            self.best = entry
+        return entry
+
+    def insert(self, block_hash, parent, height, chain_work, validated, block=None):
+        entry = BlockIndexEntry(block_hash, parent, height, chain_work, validated, self.sequence, block)
+        self.sequence += 1
+        self.entries[block_hash] = entry
+        return entry
+
+    def insert_stored(self, height):
+        return self.insert(self.store.hash_at(height), None, height, self.store.chain_work(height), True)
+
+    def load(self, block_hash):
+        """ The entry of a stored block below the lowest loaded one, loading the blocks in between; or None. """
+        height = self.store.height_of(block_hash)
+        if height is None or height >= self.base.height:
+            return None
+        while self.base.height > height:
+            parent = self.insert_stored(self.base.height - 1)
+            self.base.parent = parent
+            self.base = parent
+        return self.base
+
+    def fork_point(self, a, b):
+        """ The last entry that the chains ending in ``a`` and ``b`` have in common. """
+        while a.height > b.height:
+            a = a.parent
+        while b.height > a.height:
+            b = b.parent
+        while a is not b:
+            a, b = a.parent, b.parent
+        return a
+
+    def branch(self, fork, tip):
+        """ Entries after ``fork`` up to and including ``tip``, oldest first. """
+        entries = []
+        while tip is not fork:
+            entries.append(tip)
+            tip = tip.parent
+        entries.reverse()
+        return entries
+
+    def remove(self, entry):
+        """ Drop an invalid entry with all its descendants and pick the best remaining tip. """
+        removed = {entry.hash}
+        for other in sorted(self.entries.values(), key=lambda e: e.height):
+            if other.parent is not None and other.parent.hash in removed:
+                removed.add(other.hash)
+        for block_hash in removed:
+            del self.entries[block_hash]
+        self.best = max(self.entries.values(), key=lambda e: (e.chain_work, -e.sequence))
+
+    def prune(self, keep):
+        """ Forget stored blocks more than ``keep`` below the stored tip, and branches forking off below them.
+
+        Runs once the index reaches ``2 * keep`` blocks below the tip, so the
+        cost is spread over ``keep`` blocks. Forks that deep could not be
+        switched to anyway, see ``Ledger.undo_depth``.
+        """
+        floor = len(self.store) - 1 - keep
+        if floor - self.base.height < keep:
+            return
+        base = self.entries[self.store.hash_at(floor)]
+        kept = {base.hash}
+        for entry in sorted(self.entries.values(), key=lambda e: e.height):
+            if entry.height > floor and entry.parent.hash in kept:
+                kept.add(entry.hash)
+        if self.best.hash not in kept:
+            return
+        self.entries = {block_hash: self.entries[block_hash] for block_hash in kept}
+        base.parent = None
+        self.base = base
@@ -0,0 +1,151 @@
+import time
+from collections import deque
+
+
+class ChainSync:
+    """ Book-keeping for headers-first catch-up with a longer chain.
+
+    Headers are downloaded from the peer that reports the highest chain and are
+    checked before any body is fetched. The bodies of the next ``window``
+    headers are then requested from every peer whose chain is high enough, with
+    at most ``max_in_flight`` requests per peer. A body that does not arrive
+    within ``request_timeout`` seconds, or that does not match its header, is
+    requested again, preferably from another peer. Only connected peers are
+    synced from, and a peer that stalls or has no headers for the height it
+    reported is skipped until it reports a higher chain.
+    """
+
+    def __init__(self, window=64, max_in_flight=8, request_timeout=5.0, stall_timeout=30.0):
+        self.window = window
+        self.max_in_flight = max_in_flight
+        self.request_timeout = request_timeout
+        self.stall_timeout = stall_timeout
+        self.peer_heights = {}
+        # Heights claimed by peers that then failed to serve them; ignored until a peer reports more
+        self.failed_heights = {}
+        self.reset()
+
+    def reset(self):
+        self.peer = None
+        self.fork_height = None
+        self.last_hash = None
+        self.headers_done = False
+        self.headers = deque()
+        self.queued = {}
+        self.bodies = {}
+        self.in_flight = {}
+        self.branch = []
+        self.last_progress = time.time()
+
+    def on_status(self, peer, height):
+        if height <= self.failed_heights.get(peer, -1):
+            return
+        self.peer_heights[peer] = height
+
+    def forget(self, peer):
+        """ Drop the reported height of a peer that stalled or could not serve the chain it claimed. """
+        height = self.peer_heights.pop(peer, None)
+        if height is not None:
+            self.failed_heights[peer] = height
+
+    def best_peer(self, height, peers):
+        """ The connected peer with the highest chain, if it is higher than ``height``.
+
+        Heights of peers that are no longer in ``peers`` are dropped.
+        """
+        connected = set(peers)
+        for heights in (self.peer_heights, self.failed_heights):
+            for peer in [peer for peer in heights if peer not in connected]:
+                del heights[peer]
+        best = max(self.peer_heights, key=self.peer_heights.get, default=None)
+        if best is not None and self.peer_heights[best] > height:
+            return best
+        return None
+
+    def start(self, peer):
+        self.reset()
+        self.peer = peer
+
+    def is_active(self):
+        return self.peer is not None
+
+    def is_stalled(self):
+        return time.time() - self.last_progress > self.stall_timeout
+
+    def add_headers(self, fork_height, headers):
+        """ Queue checked headers; the first one extends the block at ``fork_height``. """
+        if self.fork_height is None:
+            self.fork_height = fork_height
+        self.headers.extend(headers)
+        self.queued.update((header.hash, header) for header in headers)
+        self.last_hash = headers[-1].hash
+        self.last_progress = time.time()
+
+    def height_of(self, index):
+        """ Height of the index-th queued header. """
+        return self.fork_height + len(self.branch) + index + 1
+
+    def next_height(self):
+        """ Height of the header that should come after the queued ones. """
+        return self.height_of(len(self.headers))
+
+    def requests(self, peers):
+        """ Body requests to send now to the given connected peers, as ``(peer, block_hash)`` pairs. """
+        now = time.time()
+        load = {}
+        for peer, deadline in self.in_flight.values():
+            if deadline > now:
+                load[peer] = load.get(peer, 0) + 1
+
+        requests = []
+        for index in range(min(self.window, len(self.headers))):
+            block_hash = self.headers[index].hash
+            if block_hash in self.bodies:
+                continue
+            previous, deadline = self.in_flight.get(block_hash, (None, 0))
+            if deadline > now:
+                continue
+
+            height = self.height_of(index)
+            candidates = [peer for peer in peers
+                          if self.peer_heights.get(peer, -1) >= height and load.get(peer, 0) < self.max_in_flight]
+            if not candidates:
+                continue
+            # Least loaded first, and only back to the same peer if nobody else has it
+            peer = min(candidates, key=lambda p: (p == previous, load.get(p, 0)))
+            load[peer] = load.get(peer, 0) + 1
+            self.in_flight[block_hash] = (peer, now + self.request_timeout)
+            requests.append((peer, block_hash))
+        return requests
+
+    def is_requested(self, block_hash):
+        return block_hash in self.in_flight
+
+    def header(self, block_hash):
+        return self.queued.get(block_hash)
+
+    def on_body(self, block_hash, transactions):
+        self.in_flight.pop(block_hash, None)
+        self.bodies[block_hash] = transactions
+        self.last_progress = time.time()
+
+    def on_bad_body(self, block_hash):
+        peer, _ = self.in_flight.get(block_hash, (None, 0))
+        self.in_flight[block_hash] = (peer, 0)
+
+    def take_ready(self):
+        """ Move headers whose bodies arrived, in order, to ``branch`` as ``(header, transactions)``. """
+        while self.headers and self.headers[0].hash in self.bodies:
+            header = self.headers.popleft()
+            del self.queued[header.hash]
+            self.branch.append((header, self.bodies.pop(header.hash)))
+        return self.branch
+
+    def on_connected(self):
+        """ The branch is now part of the chain; continue from its last block. """
+        self.fork_height += len(self.branch)
+        self.branch = []
+
+    def is_done(self):
+        """ All headers were downloaded and every body arrived. """
+        return self.headers_done and not self.headers
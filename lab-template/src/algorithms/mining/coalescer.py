@@ -0,0 +1,48 @@
+import asyncio
+
+
+class SendCoalescer:
+    """ Buffers outgoing transactions per peer and sends each buffer as one batch.
+
+    A buffer is flushed ``window`` seconds after its first transaction, or
+    right away once it holds ``max_count`` transactions. Adding a transaction
+    that would push it past ``max_bytes`` flushes the buffer first, so a batch
+    stays within a single datagram.
+    """
+
+    def __init__(self, send, window=0.05, max_count=64, max_bytes=8192, tx_size=None):
+        self.send = send
+        self.window = window
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.tx_size = tx_size or (lambda signed_tx: len(signed_tx.encode()))
+        self.buffers = {}
+        self.sizes = {}
+        self.timers = {}
+
+    def add(self, peer, signed_tx):
+        size = self.tx_size(signed_tx)
+        if peer in self.buffers and self.sizes[peer] + size > self.max_bytes:
+            self.flush(peer)
+
+        self.buffers.setdefault(peer, []).append(signed_tx)
+        self.sizes[peer] = self.sizes.get(peer, 0) + size
+        if len(self.buffers[peer]) >= self.max_count:
+            self.flush(peer)
+        elif peer not in self.timers:
+            loop = asyncio.get_running_loop()
+            self.timers[peer] = loop.call_later(self.window, self.flush, peer)
+
+    def flush(self, peer=None):
+        """ Send the buffer of ``peer`` now, or every buffer when no peer is given. """
+        if peer is None:
+            for peer in list(self.buffers):
+                self.flush(peer)
+            return
+        timer = self.timers.pop(peer, None)
+        if timer is not None:
+            timer.cancel()
+        self.sizes.pop(peer, None)
+        signed_txs = self.buffers.pop(peer, None)
+        if signed_txs:
+            self.send(peer, signed_txs)
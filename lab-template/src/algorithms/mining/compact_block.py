@@ -0,0 +1,75 @@
+import os
+import struct
+from hashlib import blake2b
+
+SHORT_ID_SIZE = 6
+SALT_SIZE = 8
+INDEX = struct.Struct('>I')
+
+
+def new_salt():
+    return os.urandom(SALT_SIZE)
+
+
+def short_id(salt, tx_id):
+    """ 6-byte id of a transaction, keyed with the block's salt so collisions can't be precomputed. """
+    return blake2b(tx_id, key=salt, digest_size=SHORT_ID_SIZE).digest()
+
+
+def pack_short_ids(salt, tx_ids):
+    return b''.join(short_id(salt, tx_id) for tx_id in tx_ids)
+
+
+def unpack_short_ids(data):
+    return [data[i:i + SHORT_ID_SIZE] for i in range(0, len(data) - SHORT_ID_SIZE + 1, SHORT_ID_SIZE)]
+
+
+def pack_indexes(indexes):
+    return b''.join(INDEX.pack(index) for index in indexes)
+
+
+def unpack_indexes(data):
+    return [index for (index,) in INDEX.iter_unpack(data[:len(data) - len(data) % INDEX.size])]
+
+
+class PartialBlock:
+    """ A compact block being rebuilt from transactions that are already known locally.
+
+    Every known transaction is hashed to its short id under the block's salt and
+    put in the slots that carry that id. A short id matched by two different
+    transactions is left empty, so the transaction is requested instead of guessed.
+    """
+
+    def __init__(self, header, salt, short_ids, known):
+        self.header = header
+        self.transactions = [None] * len(short_ids)
+        slots = {}
+        for index, sid in enumerate(short_ids):
+            slots.setdefault(sid, []).append(index)
+
+        matches = {}
+        collisions = set()
+        for tx in known:
+            sid = short_id(salt, tx.digest())
+            if sid not in slots:
+                continue
+            match = matches.get(sid)
+            if match is not None and match.digest() != tx.digest():
+                collisions.add(sid)
+            matches[sid] = tx
+
+        for sid, tx in matches.items():
+            if sid not in collisions:
+                for index in slots[sid]:
+                    self.transactions[index] = tx
+
+    def missing(self):
+        return [index for index, tx in enumerate(self.transactions) if tx is None]
+
+    def fill(self, indexes, transactions):
+        for index, tx in zip(indexes, transactions):
+            if index < len(self.transactions):
+                self.transactions[index] = tx
+
+    def is_complete(self):
+        return all(tx is not None for tx in self.transactions)
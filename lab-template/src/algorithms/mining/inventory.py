@@ -0,0 +1,74 @@
+import time
+
+TX_ID_SIZE = 32
+
+
+def pack_ids(tx_ids):
+    return b''.join(tx_ids)
+
+
+def unpack_ids(data):
+    return [data[i:i + TX_ID_SIZE] for i in range(0, len(data) - TX_ID_SIZE + 1, TX_ID_SIZE)]
+
+
+class InventoryGossip:
+    """ Book-keeping for announce/request gossip of transactions.
+
+    New transactions are announced to peers by id, in batches. A peer that
+    lacks a transaction requests its body from one announcer. If the body does
+    not arrive within ``request_timeout`` seconds, the request moves on to the
+    next peer that announced the same id.
+    """
+
+    def __init__(self, request_timeout=2.0, max_batch=256):
+        self.request_timeout = request_timeout
+        self.max_batch = max_batch
+        self.outbox = {}
+        self.announcers = {}
+        self.requested = {}
+
+    def announce(self, tx_id, peers, source=None):
+        """ Queue an announcement of ``tx_id`` for every peer except the one it came from. """
+        for peer in peers:
+            if peer != source:
+                self.outbox.setdefault(peer, []).append(tx_id)
+
+    def take_announcements(self):
+        """ Drain the outbox as ``(peer, tx_ids)`` pairs of at most ``max_batch`` ids. """
+        outbox, self.outbox = self.outbox, {}
+        for peer, tx_ids in outbox.items():
+            for i in range(0, len(tx_ids), self.max_batch):
+                yield peer, tx_ids[i:i + self.max_batch]
+
+    def on_announced(self, peer, tx_ids):
+        """ Record an announcement of missing ids; returns the ids to request from ``peer`` now. """
+        now = time.time()
+        request = []
+        for tx_id in tx_ids:
+            if tx_id in self.requested:
+                self.announcers.setdefault(tx_id, []).append(peer)
+            else:
+                self.requested[tx_id] = (peer, now + self.request_timeout)
+                request.append(tx_id)
+        return request
+
+    def on_received(self, tx_id):
+        self.requested.pop(tx_id, None)
+        self.announcers.pop(tx_id, None)
+
+    def retry_expired(self):
+        """ Re-request timed out ids from other announcers, as ``(peer, tx_ids)`` pairs. """
+        now = time.time()
+        retries = {}
+        for tx_id, (peer, deadline) in list(self.requested.items()):
+            if deadline > now:
+                continue
+            fallbacks = self.announcers.get(tx_id)
+            if not fallbacks:
+                # Nobody else announced it; a later announcement starts over
+                self.on_received(tx_id)
+                continue
+            peer = fallbacks.pop(0)
+            self.requested[tx_id] = (peer, now + self.request_timeout)
+            retries.setdefault(peer, []).append(tx_id)
+        return list(retries.items())
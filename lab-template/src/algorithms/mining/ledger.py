@@ -0,0 +1,75 @@
+from collections import OrderedDict
+
+from accounts import AccountTable
+
+# Balances are stored as signed 64-bit integers, see AccountTable
+MIN_BALANCE = -2 ** 63
+MAX_BALANCE = 2 ** 63 - 1
+
+
+class Ledger:
+    """ Account balances of the active chain, with an undo record for each of the last ``undo_depth`` blocks.
+
+    Applying a block saves the balance every touched account had before it, so
+    rolling the block back restores exactly those accounts. Blocks must be
+    rolled back newest first.
+    """
+
+    def __init__(self, undo_depth=100, initial_balance=1000):
+        self.accounts = AccountTable(initial_balance)
+        self.undo_depth = undo_depth
+        self.undo = OrderedDict()
+
+    def apply_block(self, block):
+        """ Apply the transactions of ``block`` and keep its undo record.
+
+        Raises ValueError without changing any balance if an amount is not
+        positive or a balance would leave the signed 64-bit range of the
+        account table.
+        """
+        accounts = self.accounts
+        balances = accounts.balances
+        changed = {}
+        for signed_tx in block.transactions:
+            tx = signed_tx.transaction
+            if tx.amount <= 0:
+                raise ValueError(f"Block {block.hash} transfers a non-positive amount {tx.amount}")
+            sender = accounts.id_of(tx.sender)
+            receiver = accounts.id_of(tx.receiver)
+            changed[sender] = changed.get(sender, balances[sender]) - tx.amount
+            changed[receiver] = changed.get(receiver, balances[receiver]) + tx.amount
+        for account, balance in changed.items():
+            if not MIN_BALANCE <= balance <= MAX_BALANCE:
+                raise ValueError(f"Block {block.hash} takes the balance of {accounts.name_of(account)} out of range")
+
+        undo = {account: balances[account] for account in changed}
+        for account, balance in changed.items():
+            balances[account] = balance
+        self.undo[block.hash] = undo
+        if len(self.undo) > self.undo_depth:
+            self.undo.popitem(last=False)
+        return undo
+
+    def balance(self, account):
+        return self.accounts.balance(account)
+
+    def balances_before(self, depth):
+        """ ``{account: balance}`` as it was ``depth`` blocks ago; at most ``len(self.undo)`` back. """
+        balances = dict(self.accounts.items())
+        name_of = self.accounts.name_of
+        for undo in list(reversed(self.undo.values()))[:depth]:
+            for account, balance in undo.items():
+                balances[name_of(account)] = balance
+        return balances
+
+    def can_rollback(self, blocks):
+        return all(block.hash in self.undo for block in blocks)
+
+    def rollback(self, block):
+        block_hash, undo = self.undo.popitem()
+        if block_hash != block.hash:
+            self.undo[block_hash] = undo
+            raise ValueError(f"Block {block.hash} is not the last applied block")
+        balances = self.accounts.balances
+        for account, balance in undo.items():
+            balances[account] = balance
@@ -0,0 +1,112 @@
+from bisect import bisect_right, insort
+
+
+def sender_nonce(tx):
+    return tx.sender, tx.nonce
+
+
+class Mempool:
+    """ Pending transactions indexed by id, with one nonce-ordered queue per sender.
+
+    The pool is capped by ``max_count`` transactions and, when ``tx_size`` is
+    given, by ``max_bytes``. When a cap is exceeded the highest-nonce
+    transaction of the longest sender queue is evicted, so one busy sender
+    cannot push everybody else out and no queue gets a gap in its nonces.
+    """
+
+    def __init__(self, max_count=10000, max_bytes=None, tx_id=sender_nonce, tx_size=None):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.tx_id = tx_id
+        self.tx_size = tx_size
+        self.txs = {}
+        self.sizes = {}
+        self.total_bytes = 0
+        # sender -> {nonce: tx id}, plus the nonces of each sender in sorted order
+        self.by_sender = {}
+        self.nonces = {}
+
+    def __len__(self):
+        return len(self.txs)
+
+    def __contains__(self, tx_id):
+        return tx_id in self.txs
+
+    def __iter__(self):
+        return iter(self.txs.values())
+
+    def get(self, tx_id):
+        return self.txs.get(tx_id)
+
+    def has(self, sender, nonce):
+        return nonce in self.by_sender.get(sender, ())
+
+    def add(self, tx):
+        """ Add a transaction; returns False for duplicates or when it was evicted right away. """
+        tx_id = self.tx_id(tx)
+        if tx_id in self.txs or self.has(tx.sender, tx.nonce):
+            return False
+
+        size = self.tx_size(tx) if self.tx_size else 0
+        self.txs[tx_id] = tx
+        self.sizes[tx_id] = size
+        self.total_bytes += size
+        self.by_sender.setdefault(tx.sender, {})[tx.nonce] = tx_id
+        insort(self.nonces.setdefault(tx.sender, []), tx.nonce)
+
+        while self.is_full():
+            self.evict()
+        return tx_id in self.txs
+
+    def remove(self, tx):
+        """ Remove a transaction, e.g. once it has been applied. """
+        return self.discard(self.tx_id(tx))
+
+    def discard(self, tx_id):
+        tx = self.txs.pop(tx_id, None)
+        if tx is None:
+            return None
+        self.total_bytes -= self.sizes.pop(tx_id)
+
+        queue = self.by_sender[tx.sender]
+        del queue[tx.nonce]
+        nonces = self.nonces[tx.sender]
+        if nonces[0] == tx.nonce:
+            nonces.pop(0)
+        else:
+            nonces.remove(tx.nonce)
+        if not queue:
+            del self.by_sender[tx.sender]
+            del self.nonces[tx.sender]
+        return tx
+
+    def is_full(self):
+        if len(self.txs) > self.max_count:
+            return True
+        return self.max_bytes is not None and self.total_bytes > self.max_bytes
+
+    def evict(self):
+        sender = max(self.nonces, key=lambda s: len(self.nonces[s]))
+        return self.discard(self.by_sender[sender][self.nonces[sender][-1]])
+
+    def senders(self):
+        """ The senders with pending transactions, as a list so their queues may change meanwhile. """
+        return list(self.nonces)
+
+    def queue(self, sender):
+        """ The pending transactions of ``sender`` in nonce order, produced lazily.
+
+        The caller may remove each transaction after it is yielded. Stopping at
+        a transaction that cannot be applied yet costs nothing for the rest of
+        the queue, so a batch visits O(k + senders) transactions for k applied.
+        """
+        last = None
+        while True:
+            nonces = self.nonces.get(sender)
+            if not nonces:
+                return
+            index = 0 if last is None else bisect_right(nonces, last)
+            if index == len(nonces):
+                return
+            last = nonces[index]
+            yield self.txs[self.by_sender[sender][last]]
@@ -1,35 +1,233 @@
 from hashlib import sha256
 
+# Nodes are raw SHA-256 digests; hex strings only appear at the API boundary.
+DIGEST_SIZE = 32
+
+
+def hash_leaf(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return sha256(data).digest()
+
+
+def hash_pair(left, right):
+    return sha256(bytes(left) + bytes(right)).digest()
+
+
+def _node(data, do_hash):
+    """ Leaf digest from raw data, or from an already hashed hex/bytes value. """
+    if do_hash:
+        return hash_leaf(data)
+    if isinstance(data, str):
+        return bytes.fromhex(data)
+    return bytes(data)
+
+
+def _hex(node):
+    return bytes(node).hex()
+
+
 class MerkleTree:
-    """ Implementation of a Merkle Tree for storing transaction hashes. """
+    """ Implementation of a Merkle Tree for storing transaction hashes.
+
+    Every level is a single bytearray of concatenated 32-byte digests.
+    """
 
     def __init__(self):
-        self.leaves = []
+        self.leaves = bytearray()
         self.levels = []
 
+    def __len__(self):
+        return len(self.leaves) // DIGEST_SIZE
+
     def add_leaf(self, data, do_hash=True):
         """ Add a leaf to the Merkle Tree, optionally hashing the data. """
-        if do_hash:
-            data = sha256(data.encode('utf-8')).hexdigest()
-        self.leaves.append(data)
-        self.build_tree()
+        self.leaves += _node(data, do_hash)
+        # The levels are rebuilt lazily by get_root.
+        self.levels = []
 
     def build_tree(self):
         """ Build the Merkle Tree from the leaves. """
         self.levels = [self.leaves]
         current_level = self.leaves
-        while len(current_level) > 1:
-            new_level = []
-            for i in range(0, len(current_level), 2):
-                left = current_level[i]
-                right = current_level[i + 1] if i + 1 < len(current_level) else left
-                new_level.append(sha256((left + right).encode('utf-8')).hexdigest())
+        while len(current_level) > DIGEST_SIZE:
+            view = memoryview(current_level)
+            new_level = bytearray()
+            for i in range(0, len(current_level), 2 * DIGEST_SIZE):
+                pair = view[i:i + 2 * DIGEST_SIZE]
+                if len(pair) == DIGEST_SIZE:
+                    pair = bytes(pair) * 2
+                new_level += sha256(pair).digest()
+            view.release()
             current_level = new_level
             self.levels.append(current_level)
 
+    def node(self, height, position):
+        level = self.levels[height]
+        return level[position * DIGEST_SIZE:(position + 1) * DIGEST_SIZE]
+
     def get_root(self):
         """ Get the root hash of the Merkle Tree. """
+        self.ensure_levels()
         if self.levels:
-            return self.levels[-1][0]
+            return _hex(self.levels[-1])
         return None
 
+    def ensure_levels(self):
+        """ Build the levels once; they stay cached until the next add_leaf. """
+        if not self.levels and self.leaves:
+            self.build_tree()
+
+    def proof(self, index):
+        """ Inclusion proof for leaf ``index`` as a list of ``(sibling, sibling_is_left)``. """
+        self.ensure_levels()
+        if not 0 <= index < len(self):
+            raise IndexError(f"No leaf at index {index}")
+        path = []
+        for height, level in enumerate(self.levels[:-1]):
+            sibling = index ^ 1
+            if sibling * DIGEST_SIZE >= len(level):
+                sibling = index
+            path.append((_hex(self.node(height, sibling)), sibling < index))
+            index //= 2
+        return path
+
+    @staticmethod
+    def verify(leaf, proof, root, do_hash=True):
+        """ Check an inclusion proof from proof() against a root. """
+        node = _node(leaf, do_hash)
+        for sibling, sibling_is_left in proof:
+            sibling = bytes.fromhex(sibling)
+            node = hash_pair(sibling, node) if sibling_is_left else hash_pair(node, sibling)
+        return node.hex() == root
+
+    def multiproof(self, indices):
+        """ One proof for several leaves, sharing the sibling nodes they have in common.
+
+        Returns ``(leaf_count, nodes)`` where ``nodes`` maps ``(height, position)``
+        to the hashes that cannot be computed from the proven leaves themselves.
+        """
+        self.ensure_levels()
+        known = set(indices)
+        if any(not 0 <= index < len(self) for index in known):
+            raise IndexError(f"No leaf at one of the indices {sorted(known)}")
+        nodes = {}
+        for height, level in enumerate(self.levels[:-1]):
+            width = len(level) // DIGEST_SIZE
+            for position in known:
+                sibling = position ^ 1
+                if sibling < width and sibling not in known:
+                    nodes[(height, sibling)] = _hex(self.node(height, sibling))
+            known = {position // 2 for position in known}
+        return len(self), nodes
+
+    @staticmethod
+    def verify_multi(leaves, proof, root, do_hash=True):
+        """ Check a multiproof; ``leaves`` maps leaf index to leaf data. """
+        leaf_count, nodes = proof
+        if not leaves:
+            return False
+        if any(not 0 <= index < leaf_count for index in leaves):
+            return False
+        known = {index: _node(data, do_hash) for index, data in leaves.items()}
+        height = 0
+        width = leaf_count
+        while width > 1:
+            parents = {}
+            for position in known:
+                left = position & ~1
+                right = left + 1 if left + 1 < width else left
+                left_hash = known.get(left) or _proof_node(nodes, height, left)
+                right_hash = known.get(right) or _proof_node(nodes, height, right)
+                if left_hash is None or right_hash is None:
+                    return False
+                parents[position // 2] = hash_pair(left_hash, right_hash)
+            known = parents
+            height += 1
+            width = (width + 1) // 2
+        return 0 in known and known[0].hex() == root
+
+
+def _proof_node(nodes, height, position):
+    node = nodes.get((height, position))
+    return bytes.fromhex(node) if node is not None else None
+
+
+class MerkleAccumulator:
+    """ Append-only Merkle root that only keeps the right frontier of the tree.
+
+    ``frontier[h]`` holds the root of the last complete subtree of ``2 ** h``
+    leaves that has no right sibling yet, which is the case exactly when bit
+    ``h`` of the leaf count is set. Roots follow the same odd-node duplication
+    rule as MerkleTree, so both give the same root for the same leaves.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.frontier = []
+        self.root = None
+
+    def add_leaf(self, data, do_hash=True):
+        """ Append one leaf in O(log n). """
+        node = _node(data, do_hash)
+        height = 0
+        while self.count >> height & 1:
+            node = hash_pair(self.frontier[height], node)
+            self.frontier[height] = None
+            height += 1
+        self._set_frontier(height, node)
+        self.count += 1
+        self.root = None
+
+    def extend(self, leaves, do_hash=True):
+        """ Append many leaves, hashing one whole level of the batch at a time. """
+        level = bytearray()
+        for data in leaves:
+            level += _node(data, do_hash)
+        added = len(level) // DIGEST_SIZE
+        if not added:
+            return
+        height = 0
+        while level:
+            if self.count >> height & 1:
+                level[0:0] = self.frontier[height]
+            if len(level) // DIGEST_SIZE % 2:
+                self._set_frontier(height, bytes(level[-DIGEST_SIZE:]))
+                del level[-DIGEST_SIZE:]
+            else:
+                self._set_frontier(height, None)
+            view = memoryview(level)
+            parents = bytearray()
+            for i in range(0, len(level), 2 * DIGEST_SIZE):
+                parents += sha256(view[i:i + 2 * DIGEST_SIZE]).digest()
+            view.release()
+            level = parents
+            height += 1
+        self.count += added
+        self.root = None
+
+    def get_root(self):
+        """ Get the root hash, folding the frontier in O(log n). """
+        if self.count == 0:
+            return None
+        if self.root is None:
+            self.root = _hex(self._fold())
+        return self.root
+
+    def _fold(self):
+        top = (self.count - 1).bit_length()
+        carry = None
+        for height in range(top):
+            node = self.frontier[height] if self.count >> height & 1 else None
+            if node is not None and carry is not None:
+                carry = hash_pair(node, carry)
+            elif node is not None:
+                carry = hash_pair(node, node)
+            elif carry is not None:
+                carry = hash_pair(carry, carry)
+        return carry if carry is not None else self.frontier[top]
+
+    def _set_frontier(self, height, node):
+        while len(self.frontier) <= height:
+            self.frontier.append(None)
+        self.frontier[height] = node
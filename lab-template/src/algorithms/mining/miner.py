@@ -1,6 +1,6 @@
-from hashlib import sha256
 import time
 from block import Blockchain, Block, SignedTransaction, Transaction
+from proof_of_work import HeaderHasher, difficulty_to_target, target_to_bytes
 
 class Miner:
     def __init__(self, blockchain, difficulty_target, mempool):
@@ -9,12 +9,16 @@ class Miner:
         self.mempool = mempool
 
     def compute_hash(self, block):
-        block_string = f'{block.timestamp}{block.difficulty}{block.nonce}{block.prev_hash}{block.merkle_root}{block.coinbase_tx}'
-        return sha256(block_string.encode()).hexdigest()
+        return HeaderHasher(block.header.header_prefix()).hexdigest(block.header.nonce)
 
     def mine_block(self, block):
+        header = block.header
+        hasher = HeaderHasher(header.header_prefix())
+        target = target_to_bytes(difficulty_to_target(self.difficulty_target))
         while True:
-            if int(self.compute_hash(block), 16) < 2 ** 256 / self.difficulty_target:
+            digest = hasher.digest(header.nonce)
+            if digest < target:
+                header.hash = digest.hex()
                 print(f"Block mined by miner")
                 return
-            block.nonce += 1
\ No newline at end of file
+            header.nonce += 1
\ No newline at end of file
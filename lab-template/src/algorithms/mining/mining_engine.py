@@ -0,0 +1,112 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from proof_of_work import NONCE, HeaderHasher, target_to_bytes
+
+
+# Set in every worker process by the pool initializer, shared with the parent.
+_stop_event = None
+
+
+def _init_worker(stop_event):
+    global _stop_event
+    _stop_event = stop_event
+
+
+def search_nonces(worker_id, workers, prefix, target, chunk_size, report_interval):
+    """ Scan the chunks of the nonce space that belong to this worker.
+
+    Worker ``i`` of ``n`` takes chunks ``i, i + n, i + 2n, ...`` of ``chunk_size``
+    nonces each, so the workers never overlap. The stop event is checked between
+    chunks; the worker that finds a solution sets it for everybody else.
+    """
+    start_time = time.time()
+    last_report = start_time
+    hashes = 0
+    chunk = worker_id
+    midstate = HeaderHasher(prefix).midstate
+    target = target_to_bytes(target)
+    pack = NONCE.pack
+
+    while not _stop_event.is_set():
+        first = chunk * chunk_size
+        for nonce in range(first, first + chunk_size):
+            h = midstate.copy()
+            h.update(pack(nonce))
+            digest = h.digest()
+            if digest < target:
+                _stop_event.set()
+                hashes += nonce - first + 1
+                return worker_id, nonce, digest.hex(), hashes, time.time() - start_time
+        hashes += chunk_size
+        chunk += workers
+
+        now = time.time()
+        if now - last_report > report_interval:
+            print(f"[Worker {worker_id}] {hashes / (now - start_time):.0f} hashes/sec")
+            last_report = now
+
+    return worker_id, None, None, hashes, time.time() - start_time
+
+
+class MiningEngine:
+    """ Runs the proof-of-work nonce search on a pool of worker processes. """
+
+    def __init__(self, workers=None, chunk_size=20000, report_interval=2.0):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.report_interval = report_interval
+        self.stop_event = multiprocessing.Event()
+        self.executor = ProcessPoolExecutor(
+            self.workers, initializer=_init_worker, initargs=(self.stop_event,)
+        )
+        self.hash_rates = {}
+
+    async def mine(self, hasher, target):
+        """ Find a nonce whose header hash from ``hasher`` is below the numeric ``target``.
+
+        Returns ``(nonce, hash)``, or ``None`` when the search was stopped before a
+        solution was found.
+        """
+        loop = asyncio.get_running_loop()
+        self.stop_event.clear()
+        pending = {
+            loop.run_in_executor(
+                self.executor, search_nonces, worker_id, self.workers, hasher.prefix,
+                target, self.chunk_size, self.report_interval
+            )
+            for worker_id in range(self.workers)
+        }
+        solution = None
+        try:
+            while pending and solution is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    worker_id, nonce, block_hash, hashes, elapsed = future.result()
+                    self.record_rate(worker_id, hashes, elapsed)
+                    if nonce is not None and solution is None:
+                        solution = (nonce, block_hash)
+        finally:
+            # Stop the remaining workers; they exit within one chunk.
+            self.stop_event.set()
+
+        for worker_id, _, _, hashes, elapsed in await asyncio.gather(*pending):
+            self.record_rate(worker_id, hashes, elapsed)
+        return solution
+
+    def stop(self):
+        """ Abort the running search, e.g. when a competing block arrived. """
+        self.stop_event.set()
+
+    def record_rate(self, worker_id, hashes, elapsed):
+        self.hash_rates[worker_id] = hashes / elapsed if elapsed > 0 else 0.0
+
+    def total_hash_rate(self):
+        return sum(self.hash_rates.values())
+
+    def shutdown(self):
+        self.stop()
+        self.executor.shutdown()
@@ -1,11 +1,11 @@
-import json
 import random
 from base64 import b64encode
 from ipv8.community import Community, CommunitySettings
 from ipv8.lazy_community import lazy_wrapper
 from ipv8.types import Peer
 
-from transaction import Transaction, SignedTransaction
+from transaction import Transaction, SignedTransaction, TransactionBatch
+from coalescer import SendCoalescer
 from validator_community import ValidatorCommunity
 
 import time
@@ -27,6 +27,8 @@ class MyCommunity(Community):
         super().__init__(settings)
         self.counter = 1
         self.max_messages = 3
+        # Transactions to the same peer within 50 ms share one message
+        self.coalescer = SendCoalescer(self.send_batch, window=0.05, max_count=64)
         # self.overlays = {}
         # self.add_message_handler(SignedTransaction, self.on_transaction)
 
@@ -36,13 +38,17 @@ class MyCommunity(Community):
             "create_transaction", self.create_transaction, interval=1.0, delay=1.0
         )
 
+    def send_batch(self, peer: Peer, signed_txs) -> None:
+        """Send the coalesced transactions for one peer as a single batch."""
+        self.ez_send(peer, TransactionBatch(signed_txs))
+
     def serialize_transaction(self, tx: Transaction) -> bytes:
         """Serialize transaction to bytes for storage or transmission."""
-        return json.dumps(tx.__dict__, sort_keys=True).encode()
+        return tx.encode()
 
     def deserialize_transaction(self, data: bytes) -> Transaction:
         """Deserialize bytes back into Transaction object."""
-        return Transaction(**json.loads(data))
+        return Transaction.decode(data)
 
     def node_id_from_peer(self, peer: Peer) -> int:
         """Extract node ID from a peer (placeholder implementation)."""
@@ -85,7 +91,7 @@ class MyCommunity(Community):
         #     bcolors.SENDTRANSACTION
         #     + f"[Node {self.my_peer.mid}] Sending transaction {tx.nonce} to {peer_id}"
         # )
-        self.ez_send(peer, signed_tx)
+        self.coalescer.add(peer, signed_tx)
 
         if self.counter > self.max_messages:
             self.cancel_pending_task("create_transaction")
@@ -0,0 +1,56 @@
+import struct
+from hashlib import sha256
+
+# Fixed-layout block header: timestamp, difficulty, prev_hash and merkle_root,
+# followed by the nonce as the last field. The transactions are only committed
+# to through merkle_root, so hashing a header costs the same for any block size.
+HEADER_PREFIX = struct.Struct('>QI32s32s')
+NONCE = struct.Struct('>Q')
+
+EMPTY_DIGEST = b'\x00' * 32
+
+
+def difficulty_to_target(difficulty):
+    """ Numeric 256-bit target for a difficulty counted in leading zero hex digits. """
+    return 1 << (256 - 4 * difficulty)
+
+
+def header_work(difficulty):
+    """ Expected number of hashes needed to meet the target of ``difficulty``. """
+    return (1 << 256) // difficulty_to_target(difficulty)
+
+
+def target_to_bytes(target):
+    """ Big-endian form of the target, so digests can be compared as bytes. """
+    return min(target, (1 << 256) - 1).to_bytes(32, 'big')
+
+
+def meets_target(digest, target):
+    return int.from_bytes(digest, 'big') < target
+
+
+def _digest_field(value):
+    if not value:
+        return EMPTY_DIGEST
+    return bytes.fromhex(value)
+
+
+def header_prefix(timestamp, difficulty, prev_hash, merkle_root):
+    """ Encode every header field except the nonce. """
+    return HEADER_PREFIX.pack(timestamp, difficulty, _digest_field(prev_hash), _digest_field(merkle_root))
+
+
+class HeaderHasher:
+    """ Hashes a header for many nonces, reusing the SHA-256 state of the constant prefix. """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.midstate = sha256(prefix)
+
+    def digest(self, nonce):
+        h = self.midstate.copy()
+        h.update(NONCE.pack(nonce))
+        return h.digest()
+
+    def hexdigest(self, nonce):
+        return self.digest(nonce).hex()
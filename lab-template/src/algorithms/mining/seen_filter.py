@@ -0,0 +1,133 @@
+import math
+import struct
+import time
+from collections import OrderedDict
+from hashlib import sha256
+
+
+FILTER_HEADER = struct.Struct('>qI')  # epoch, number of Bloom filters
+BLOOM_HEADER = struct.Struct('>QII')  # bits, hashes, ids added
+RECENT_COUNT = struct.Struct('>I')
+
+
+class BloomFilter:
+    """ Fixed-size Bloom filter over 32-byte ids, sized for ``capacity`` ids at ``fp_rate``. """
+
+    def __init__(self, capacity, fp_rate):
+        self.size = max(8, int(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        # The ids are already uniform hashes, so two slices of them drive double hashing.
+        h1 = int.from_bytes(key[:8], 'big')
+        h2 = int.from_bytes(key[8:16], 'big') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+    def encode(self):
+        return BLOOM_HEADER.pack(self.size, self.hashes, self.count) + self.bits
+
+
+class SeenFilter:
+    """ Bounded memory of which transaction ids were seen during roughly the last ``window`` seconds.
+
+    The window is split into ``buckets`` Bloom filters; the oldest one is dropped
+    when time moves to the next bucket, or earlier when the current bucket holds
+    ``capacity`` ids. Each bucket is sized for ``fp_rate / buckets``, so a lookup
+    that checks all of them reports an unseen id as seen with probability at most
+    about ``fp_rate``. The ``recent_size`` most recent ids are also kept in an exact
+    set that answers the common case of an id that was just seen.
+
+    Memory is ``buckets * capacity * -ln(fp_rate / buckets) / ln(2)^2`` bits plus
+    the exact set, e.g. about 1.4 MB for the defaults.
+    """
+
+    def __init__(self, window=600.0, buckets=6, capacity=100000, fp_rate=0.001, recent_size=4096):
+        self.bucket_span = window / buckets
+        self.capacity = capacity
+        self.bucket_fp_rate = fp_rate / buckets
+        self.recent_size = recent_size
+        self.recent = OrderedDict()
+        self.filters = [BloomFilter(capacity, self.bucket_fp_rate) for _ in range(buckets)]
+        self.epoch = self.current_epoch()
+
+    def current_epoch(self):
+        return int(time.time() / self.bucket_span)
+
+    def rotate(self):
+        epoch = self.current_epoch()
+        steps = min(epoch - self.epoch, len(self.filters))
+        if self.filters[-1].count >= self.capacity:
+            steps = max(steps, 1)
+        for _ in range(steps):
+            self.filters.pop(0)
+            self.filters.append(BloomFilter(self.capacity, self.bucket_fp_rate))
+        self.epoch = epoch
+
+    def __contains__(self, tx_id):
+        key = self.key(tx_id)
+        if key in self.recent:
+            return True
+        self.rotate()
+        return any(key in bloom for bloom in self.filters)
+
+    def add(self, tx_id):
+        key = self.key(tx_id)
+        self.rotate()
+        self.filters[-1].add(key)
+        self.recent[key] = None
+        if len(self.recent) > self.recent_size:
+            self.recent.popitem(last=False)
+
+    def encode(self):
+        """ Binary form of the window, for snapshots. """
+        parts = [FILTER_HEADER.pack(self.epoch, len(self.filters))]
+        parts.extend(bloom.encode() for bloom in self.filters)
+        parts.append(RECENT_COUNT.pack(len(self.recent)))
+        parts.extend(bytes([len(key)]) + key for key in self.recent)
+        return b''.join(parts)
+
+    def restore(self, data):
+        """ Load a window written by encode(); returns False if it was made with other parameters. """
+        epoch, count = FILTER_HEADER.unpack_from(data)
+        offset = FILTER_HEADER.size
+        filters = []
+        for bloom in self.filters[:count]:
+            size, hashes, added = BLOOM_HEADER.unpack_from(data, offset)
+            offset += BLOOM_HEADER.size
+            if size != bloom.size or hashes != bloom.hashes:
+                return False
+            restored = BloomFilter(self.capacity, self.bucket_fp_rate)
+            restored.bits[:] = data[offset:offset + len(restored.bits)]
+            restored.count = added
+            offset += len(restored.bits)
+            filters.append(restored)
+        if count != len(self.filters):
+            return False
+
+        (recent,) = RECENT_COUNT.unpack_from(data, offset)
+        offset += RECENT_COUNT.size
+        self.recent.clear()
+        for _ in range(recent):
+            length = data[offset]
+            self.recent[bytes(data[offset + 1:offset + 1 + length])] = None
+            offset += 1 + length
+        self.filters = filters
+        self.epoch = epoch
+        self.rotate()
+        return True
+
+    @staticmethod
+    def key(tx_id):
+        if isinstance(tx_id, bytes) and len(tx_id) >= 16:
+            return tx_id
+        return sha256(repr(tx_id).encode()).digest()
@@ -0,0 +1,121 @@
+import asyncio
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+
+def verify_batch(items):
+    """ Verify ``(public_key, data, signature)`` triples in a worker process. """
+    from ipv8.keyvault.crypto import default_eccrypto
+
+    results = []
+    for public_key, data, signature in items:
+        try:
+            key = default_eccrypto.key_from_public_bin(public_key)
+            results.append(default_eccrypto.is_valid_signature(key, data, signature))
+        except Exception:
+            results.append(False)
+    return results
+
+
+class VerifiedCache:
+    """ The last ``capacity`` signed transactions whose signature checked out.
+
+    Entries are keyed by the transaction id together with the signature and
+    public key, so a transaction only counts as verified with the exact
+    signature that was checked. ``hits`` and ``misses`` count the lookups.
+    """
+
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(signed_tx):
+        return signed_tx.digest(), signed_tx.signature, signed_tx.public_key
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, signed_tx):
+        key = self.key(signed_tx)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, signed_tx):
+        key = self.key(signed_tx)
+        self.entries[key] = None
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class SignatureVerifier:
+    """ Verifies signatures off the event loop, in micro-batches on a process pool.
+
+    ``verify`` queues a request and waits for its result. The queue holds at
+    most ``max_pending`` requests, so when the workers fall behind, callers
+    wait in ``verify`` instead of piling up more work.
+    """
+
+    def __init__(self, workers=None, batch_size=64, max_delay=0.005, max_pending=4096):
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue(max_pending)
+        self.in_flight = asyncio.Semaphore(2 * self.workers)
+        self.executor = ProcessPoolExecutor(self.workers)
+
+    async def verify(self, public_key, data, signature):
+        """ Resolve to True when ``signature`` over ``data`` matches the binary ``public_key``. """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((public_key, data, signature, future))
+        return await future
+
+    async def run(self):
+        """ Collect requests into batches and hand them to the pool; runs until cancelled. """
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.in_flight.acquire()
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.batch_size:
+                if self.queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(self.queue.get_nowait())
+            asyncio.ensure_future(self.dispatch(batch))
+
+    async def dispatch(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(
+                self.executor, verify_batch, [item[:3] for item in batch]
+            )
+        except Exception as e:
+            print(f"Error verifying signatures: {e}")
+            results = [False] * len(batch)
+        finally:
+            self.in_flight.release()
+        for (_, _, _, future), valid in zip(batch, results):
+            if not future.done():
+                future.set_result(valid)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,126 @@
+import os
+import struct
+
+from transaction import Transaction, SignedTransaction
+
+SNAPSHOT_MAGIC = b'LSNP'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct('>4sHQ32sI')  # magic, version, height, tip hash, number of accounts
+ACCOUNT_NAME = struct.Struct('>H')
+BALANCE = struct.Struct('>q')
+SECTION_LENGTH = struct.Struct('>I')
+ACCOUNT_STATE = struct.Struct('>qQ')  # balance and last applied nonce of a validator account
+COUNT = struct.Struct('>I')
+TX_LENGTH = struct.Struct('>H')
+
+
+def encode_name(name):
+    data = name.encode('utf-8')
+    return ACCOUNT_NAME.pack(len(data)) + data
+
+
+def decode_name(data, offset):
+    (length,) = ACCOUNT_NAME.unpack_from(data, offset)
+    offset += ACCOUNT_NAME.size
+    return data[offset:offset + length].decode('utf-8'), offset + length
+
+
+def encode_transactions(transactions):
+    parts = [COUNT.pack(len(transactions))]
+    for tx in transactions:
+        data = tx.encode()
+        parts.append(TX_LENGTH.pack(len(data)) + data)
+    return b''.join(parts)
+
+
+def decode_transactions(data, offset, decode):
+    (count,) = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+    transactions = []
+    for _ in range(count):
+        (length,) = TX_LENGTH.unpack_from(data, offset)
+        offset += TX_LENGTH.size
+        transactions.append(decode(data[offset:offset + length]))
+        offset += length
+    return transactions, offset
+
+
+class Snapshot:
+    """ Account balances at a block height, plus the state of the validator that goes with them.
+
+    The validator part is its serialized dedup window, its own account
+    balances and nonces, and the transactions it accepted but did not apply
+    (``pending``) or did not see in a block yet (``mempool``). They are saved
+    together: restoring the dedup window alone would make the node ignore
+    transactions it has seen but no longer holds.
+    """
+
+    def __init__(self, height, tip_hash, balances, seen=b'', accounts=None, pending=(), mempool=()):
+        self.height = height
+        self.tip_hash = tip_hash
+        self.balances = balances
+        self.seen = seen
+        # {account: (balance, nonce)}
+        self.accounts = accounts or {}
+        self.pending = list(pending)
+        self.mempool = list(mempool)
+
+    def encode(self):
+        parts = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.height,
+                                      bytes.fromhex(self.tip_hash), len(self.balances))]
+        for account, balance in self.balances.items():
+            parts.append(encode_name(account) + BALANCE.pack(balance))
+        parts.append(SECTION_LENGTH.pack(len(self.seen)) + self.seen)
+        parts.append(COUNT.pack(len(self.accounts)))
+        for account, (balance, nonce) in self.accounts.items():
+            parts.append(encode_name(account) + ACCOUNT_STATE.pack(balance, nonce))
+        parts.append(encode_transactions(self.pending))
+        parts.append(encode_transactions(self.mempool))
+        return b''.join(parts)
+
+    @classmethod
+    def decode(cls, data):
+        magic, version, height, tip_hash, count = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError("Not a ledger snapshot of this version")
+        offset = SNAPSHOT_HEADER.size
+        balances = {}
+        for _ in range(count):
+            account, offset = decode_name(data, offset)
+            (balances[account],) = BALANCE.unpack_from(data, offset)
+            offset += BALANCE.size
+        (length,) = SECTION_LENGTH.unpack_from(data, offset)
+        offset += SECTION_LENGTH.size
+        seen = data[offset:offset + length]
+        offset += length
+
+        (count,) = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+        accounts = {}
+        for _ in range(count):
+            account, offset = decode_name(data, offset)
+            accounts[account] = ACCOUNT_STATE.unpack_from(data, offset)
+            offset += ACCOUNT_STATE.size
+        pending, offset = decode_transactions(data, offset, Transaction.decode)
+        mempool, offset = decode_transactions(data, offset, SignedTransaction.decode)
+        return cls(height, tip_hash.hex(), balances, seen, accounts, pending, mempool)
+
+
+def write_snapshot(path, snapshot):
+    """ Encode and write a snapshot so that ``path`` always holds a complete one; blocking. """
+    data = snapshot.encode()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path):
+    """ The snapshot at ``path``, or None if there is none or it is unreadable. """
+    try:
+        with open(path, 'rb') as f:
+            return Snapshot.decode(f.read())
+    except (OSError, ValueError, struct.error, UnicodeDecodeError):
+        return None
@@ -0,0 +1,47 @@
+import asyncio
+import tempfile
+
+from block import Blockchain
+from transaction import Transaction, SignedTransaction
+
+
+def signed(sender, receiver, amount, nonce):
+    return SignedTransaction(Transaction(sender, receiver, amount, nonce, 1000 + nonce), "signature", sender)
+
+
+async def mine(blockchain, sender, count):
+    for nonce in range(1, count + 1):
+        await blockchain.create_new_block([signed(sender, "receiver", 1, nonce)])
+
+
+def test_reorg_below_restart_tip():
+    """ A heavier branch forking off below the tip of a reopened store replaces the stored chain. """
+    store_dir = tempfile.mkdtemp()
+
+    async def run():
+        local = Blockchain(0, 1, mining_workers=1, undo_depth=10, store_dir=store_dir)
+        await mine(local, "local", 4)
+        snapshot = local.snapshot()
+        local.chain.close()
+        local.mining_engine.shutdown()
+
+        other = Blockchain(1, 1, mining_workers=1)
+        await mine(other, "other", 6)
+        branch = other.chain[1:]
+        other.mining_engine.shutdown()
+
+        reopened = Blockchain(0, 1, mining_workers=1, undo_depth=10, store_dir=store_dir, snapshot=snapshot)
+        try:
+            assert reopened.height() == 4
+            connected, disconnected = reopened.connect_blocks(branch)
+            assert [block.hash for block in connected] == [block.hash for block in branch]
+            assert len(disconnected) == 4
+            assert reopened.height() == 6
+            assert reopened.chain[-1].hash == branch[-1].hash
+            assert reopened.ledger.balance("local") == 1000
+            assert reopened.ledger.balance("other") == 994
+        finally:
+            reopened.chain.close()
+            reopened.mining_engine.shutdown()
+
+    asyncio.run(run())
@@ -1,10 +1,29 @@
+import struct
 import time
 from dataclasses import dataclass
+from typing import List
+from hashlib import sha256
 from ipv8.messaging.payload_dataclass import overwrite_dataclass
 
 # We are using a custom dataclass implementation.
 dataclass = overwrite_dataclass(dataclass)
 
+# Canonical encoding: length-prefixed UTF-8 strings, then fixed-width integers.
+STRING_LENGTH = struct.Struct('>H')
+TX_NUMBERS = struct.Struct('>qQQ')
+
+
+def encode_string(value):
+    data = value.encode('utf-8')
+    return STRING_LENGTH.pack(len(data)) + data
+
+
+def decode_string(data, offset):
+    (length,) = STRING_LENGTH.unpack_from(data, offset)
+    offset += STRING_LENGTH.size
+    return data[offset:offset + length].decode('utf-8'), offset + length
+
+
 @dataclass(msg_id=1)  # The value 1 identifies this message and must be unique per community.
 class Transaction:
     """ Represents a basic transaction. """
@@ -21,9 +40,75 @@ class Transaction:
         self.nonce = nonce
         self.ts = ts if ts is not None else int(time.time())
 
+    def encode(self) -> bytes:
+        """ Canonical binary encoding, computed once per object. """
+        encoded = self.__dict__.get('_encoded')
+        if encoded is None:
+            encoded = (encode_string(self.sender) + encode_string(self.receiver)
+                       + TX_NUMBERS.pack(self.amount, self.nonce, self.ts))
+            self._encoded = encoded
+        return encoded
+
+    def digest(self) -> bytes:
+        """ SHA-256 of the canonical encoding; this is the transaction id. """
+        digest = self.__dict__.get('_digest')
+        if digest is None:
+            digest = self._digest = sha256(self.encode()).digest()
+        return digest
+
+    @classmethod
+    def decode(cls, data: bytes) -> 'Transaction':
+        sender, offset = decode_string(data, 0)
+        receiver, offset = decode_string(data, offset)
+        amount, nonce, ts = TX_NUMBERS.unpack_from(data, offset)
+        return cls(sender, receiver, amount, nonce, ts)
+
+    def to_dict(self) -> dict:
+        return {'sender': self.sender, 'receiver': self.receiver, 'amount': self.amount,
+                'nonce': self.nonce, 'ts': self.ts}
+
 @dataclass(msg_id=2)  # The value 2 identifies this message and must be unique per community.
 class SignedTransaction:
     """ Represents a signed transaction including a signature and public key. """
     transaction: Transaction
     signature: str
     public_key: str
+
+    def encode(self) -> bytes:
+        """ Canonical binary encoding, computed once per object. """
+        encoded = self.__dict__.get('_encoded')
+        if encoded is None:
+            encoded = (self.transaction.encode() + encode_string(self.signature)
+                       + encode_string(self.public_key))
+            self._encoded = encoded
+        return encoded
+
+    def digest(self) -> bytes:
+        """ The id of the signed transaction is the id of the transaction itself. """
+        return self.transaction.digest()
+
+    @classmethod
+    def decode(cls, data: bytes) -> 'SignedTransaction':
+        transaction = Transaction.decode(data)
+        signature, offset = decode_string(data, len(transaction.encode()))
+        public_key, offset = decode_string(data, offset)
+        return cls(transaction, signature, public_key)
+
+    def to_dict(self) -> dict:
+        return {'transaction': self.transaction.to_dict(), 'signature': self.signature,
+                'public_key': self.public_key}
+
+@dataclass(msg_id=3)
+class TransactionInventory:
+    """ Announces transactions by their concatenated 32-byte ids. """
+    tx_ids: bytes
+
+@dataclass(msg_id=4)
+class TransactionRequest:
+    """ Asks the announcer for the bodies of the concatenated 32-byte ids. """
+    tx_ids: bytes
+
+@dataclass(msg_id=5)
+class TransactionBatch:
+    """ Several signed transactions packed into one message. """
+    transactions: List[SignedTransaction]
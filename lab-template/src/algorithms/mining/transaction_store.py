@@ -0,0 +1,137 @@
+from array import array
+
+from transaction import STRING_LENGTH, TX_NUMBERS, Transaction, SignedTransaction
+
+DIGEST_SIZE = 32
+# Public key column value of a transaction that was stored without signature
+UNSIGNED = 0xFFFFFFFF
+
+
+class TransactionStore:
+    """ Transactions in parallel typed arrays instead of one object each.
+
+    Senders, receivers and public keys are stored as ids of a shared
+    AccountTable; amounts, nonces and timestamps as machine integers. Transaction
+    ids and signatures live in two byte arenas, signatures with an offset column
+    since their length varies. A row takes about 80 bytes plus its signature.
+
+    Slicing, ``select`` and ``rows`` only copy columns. Objects are built
+    only when a row is indexed or iterated, e.g. to put it in a block.
+    """
+
+    def __init__(self, accounts):
+        self.accounts = accounts
+        self.senders = array('I')
+        self.receivers = array('I')
+        self.public_keys = array('I')
+        self.amounts = array('q')
+        self.nonces = array('Q')
+        self.timestamps = array('Q')
+        self.digests = bytearray()
+        self.signatures = bytearray()
+        self.signature_ends = array('Q')
+
+    def __len__(self):
+        return len(self.senders)
+
+    def __repr__(self):
+        return f"TransactionStore({len(self)} transactions)"
+
+    def append(self, tx):
+        """ Add a Transaction or SignedTransaction as the last row. """
+        signed_tx = tx if isinstance(tx, SignedTransaction) else None
+        if signed_tx is not None:
+            tx = signed_tx.transaction
+            self.public_keys.append(self.accounts.id_of(signed_tx.public_key))
+            self.signatures += signed_tx.signature.encode('utf-8')
+        else:
+            self.public_keys.append(UNSIGNED)
+        self.signature_ends.append(len(self.signatures))
+        self.senders.append(self.accounts.id_of(tx.sender))
+        self.receivers.append(self.accounts.id_of(tx.receiver))
+        self.amounts.append(tx.amount)
+        self.nonces.append(tx.nonce)
+        self.timestamps.append(tx.ts)
+        self.digests += tx.digest()
+
+    def extend(self, txs):
+        for tx in txs:
+            self.append(tx)
+
+    def digest(self, index):
+        return bytes(self.digests[index * DIGEST_SIZE:(index + 1) * DIGEST_SIZE])
+
+    def signature(self, index):
+        start = self.signature_ends[index - 1] if index > 0 else 0
+        return self.signatures[start:self.signature_ends[index]].decode('utf-8')
+
+    def size(self, index):
+        """ Length of the canonical encoding of the row, as it is sent and stored in a block. """
+        name_of = self.accounts.name_of
+        size = (2 * STRING_LENGTH.size + len(name_of(self.senders[index]).encode('utf-8'))
+                + len(name_of(self.receivers[index]).encode('utf-8')) + TX_NUMBERS.size)
+        public_key = self.public_keys[index]
+        if public_key != UNSIGNED:
+            start = self.signature_ends[index - 1] if index > 0 else 0
+            size += (2 * STRING_LENGTH.size + self.signature_ends[index] - start
+                     + len(name_of(public_key).encode('utf-8')))
+        return size
+
+    def rows(self):
+        """ ``(sender id, receiver id, amount, nonce, ts)`` of every row. """
+        return zip(self.senders, self.receivers, self.amounts, self.nonces, self.timestamps)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return self.take(start, max(start, stop))
+            return self.select(range(start, stop, step))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"No transaction at index {index}")
+
+        name_of = self.accounts.name_of
+        tx = Transaction(name_of(self.senders[index]), name_of(self.receivers[index]), self.amounts[index],
+                         self.nonces[index], self.timestamps[index])
+        public_key = self.public_keys[index]
+        if public_key == UNSIGNED:
+            return tx
+        return SignedTransaction(tx, self.signature(index), name_of(public_key))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def select(self, indexes):
+        """ A new store with the rows at ``indexes``, in that order. """
+        store = TransactionStore(self.accounts)
+        indexes = list(indexes)
+        for name in ('senders', 'receivers', 'public_keys', 'amounts', 'nonces', 'timestamps'):
+            column = getattr(self, name)
+            getattr(store, name).extend(column[index] for index in indexes)
+        for index in indexes:
+            store.digests += self.digests[index * DIGEST_SIZE:(index + 1) * DIGEST_SIZE]
+            start = self.signature_ends[index - 1] if index > 0 else 0
+            store.signatures += self.signatures[start:self.signature_ends[index]]
+            store.signature_ends.append(len(store.signatures))
+        return store
+
+    def take(self, start, stop):
+        """ A new store with the rows from ``start`` up to ``stop``; copies whole column ranges. """
+        store = TransactionStore(self.accounts)
+        for name in ('senders', 'receivers', 'public_keys', 'amounts', 'nonces', 'timestamps'):
+            setattr(store, name, getattr(self, name)[start:stop])
+        store.digests = self.digests[start * DIGEST_SIZE:stop * DIGEST_SIZE]
+        first = self.signature_ends[start - 1] if start > 0 else 0
+        store.signatures = self.signatures[first:self.signature_ends[stop - 1] if stop > 0 else 0]
+        store.signature_ends = array('Q', (end - first for end in self.signature_ends[start:stop]))
+        return store
+
+    def without(self, digests):
+        """ A new store without the rows whose transaction id is in ``digests``. """
+        return self.select(index for index in range(len(self)) if self.digest(index) not in digests)
+
+    def clear(self):
+        self.__init__(self.accounts)
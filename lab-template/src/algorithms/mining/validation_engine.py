@@ -0,0 +1,81 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+
+from merkle_tree import MerkleTree
+from proof_of_work import HeaderHasher, difficulty_to_target, meets_target
+
+
+def check_blocks(items):
+    """ Hashes of the blocks in ``items``, up to the first whose proof of work or Merkle root is wrong.
+
+    Each item is ``(header_prefix, nonce, difficulty, merkle_root, tx_encodings)``;
+    ``tx_encodings`` is None for a header without a body.
+    """
+    hashes = []
+    for prefix, nonce, difficulty, merkle_root, encodings in items:
+        digest = HeaderHasher(prefix).digest(nonce)
+        if not meets_target(digest, difficulty_to_target(difficulty)):
+            break
+        if encodings is not None:
+            tree = MerkleTree()
+            for data in encodings:
+                tree.add_leaf(sha256(data).digest(), do_hash=False)
+            if tree.get_root() != merkle_root:
+                break
+        hashes.append(digest.hex())
+    return hashes
+
+
+class ValidationEngine:
+    """ Checks received blocks on a pool of worker processes.
+
+    Header hashes, proof of work and Merkle roots of different blocks are
+    independent, so they are computed in chunks of ``chunk_size`` blocks in
+    parallel. Only the cheap prev_hash linkage runs in order on the event loop,
+    using the hashes returned by the workers.
+    """
+
+    def __init__(self, workers=None, chunk_size=32):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.executor = ProcessPoolExecutor(self.workers)
+
+    async def validate(self, blocks, prev_hash, start_height, difficulty):
+        """ Height of the first invalid block of ``blocks``, which should follow ``prev_hash`` at ``start_height``, or None.
+
+        Blocks without transactions are checked as headers only.
+        """
+        loop = asyncio.get_running_loop()
+        chunks = []
+        for first in range(0, len(blocks), self.chunk_size):
+            items = [self.work_item(block) for block in blocks[first:first + self.chunk_size]]
+            chunks.append((len(items), loop.run_in_executor(self.executor, check_blocks, items)))
+        hashes = []
+        for count, future in chunks:
+            chunk_hashes = await future
+            hashes.extend(chunk_hashes)
+            if len(chunk_hashes) < count:
+                break
+
+        # The headers take the hashes computed by the workers, so the event loop hashes none of them
+        for offset, (block, block_hash) in enumerate(zip(blocks, hashes)):
+            if block.prev_hash != prev_hash or block.header.difficulty != difficulty:
+                return start_height + offset
+            block.header.hash = block_hash
+            prev_hash = block_hash
+        if len(hashes) < len(blocks):
+            return start_height + len(hashes)
+        return None
+
+    @staticmethod
+    def work_item(block):
+        header = block.header
+        encodings = None
+        if block.transactions is not None:
+            encodings = [signed_tx.transaction.encode() for signed_tx in block.transactions]
+        return header.header_prefix(), header.nonce, header.difficulty, header.merkle_root, encodings
+
+    def shutdown(self):
+        self.executor.shutdown()
@@ -1,14 +1,29 @@
-import json
+import os
 import time
 from base64 import b64encode, b64decode
-from collections import defaultdict
+from collections import OrderedDict
 from ipv8.community import Community, CommunitySettings
 from ipv8.lazy_community import lazy_wrapper
 from ipv8.types import Peer
 
-from transaction import Transaction, SignedTransaction
-from block import Block, BlockMessage
-from merkle_tree import MerkleTree
+from transaction import Transaction, SignedTransaction, TransactionBatch, TransactionInventory, TransactionRequest
+from block import (MAX_BODY_BYTES, Block, BlockBody, BlockBodyRequest, BlockHeader, BlockMessage, BlockTransactions,
+                   BlockTransactionsRequest, ChainStatus, CompactBlock, GetHeaders, Headers)
+from chain_sync import ChainSync
+from validation_engine import ValidationEngine
+from compact_block import PartialBlock, new_salt, pack_indexes, pack_short_ids, unpack_indexes, unpack_short_ids
+from merkle_tree import MerkleAccumulator
+from mempool import Mempool
+from accounts import AccountTable
+from transaction_store import TransactionStore
+from signature_verifier import SignatureVerifier, VerifiedCache
+from inventory import InventoryGossip, pack_ids, unpack_ids
+from seen_filter import SeenFilter
+from snapshot import read_snapshot, write_snapshot
+from coalescer import SendCoalescer
+from batch_trigger import BatchTrigger
+from block_pipeline import BlockPipeline
+from block_assembler import BlockAssembler
 
 import asyncio
 
@@ -35,137 +50,551 @@ class ValidatorCommunity(Community):
     def __init__(self, settings: CommunitySettings) -> None:
         super().__init__(settings)
         self.executed_checks = 0
-        self.balances = defaultdict(lambda: 1000)
-        self.pending_txs = []
-        self.saved_txs_hashes = {}
-        self.finalized_txs = []
-        self.current_block_txs = []
-        self.merkle_tree = MerkleTree()
+        # Balances and applied nonces of every account, indexed by a dense account id
+        self.accounts = AccountTable(initial_balance=1000)
+        self.pending_txs = Mempool(
+            max_count=10000,
+            max_bytes=4 * 1024 * 1024,
+            tx_id=self.generate_tx_id,
+            tx_size=lambda tx: len(self.serialize_transaction(tx)),
+        )
+        # Ids of transactions seen recently, in bounded memory (see SeenFilter)
+        self.seen_txs = SeenFilter(window=600.0, capacity=100000, fp_rate=0.001)
+        self.verifier = SignatureVerifier()
+        # Signed transactions that already passed verification, so blocks only check the rest
+        self.verified = VerifiedCache(capacity=100000)
+        # Applied and block-bound transactions, stored column-wise (see TransactionStore)
+        self.finalized_txs = TransactionStore(self.accounts)
+        self.current_block_txs = TransactionStore(self.accounts)
+        self.merkle_tree = MerkleAccumulator()
+        self.gossip = InventoryGossip(request_timeout=2.0)
+        # Recently accepted signed transactions, served to peers that request them
+        self.known_txs = OrderedDict()
+        self.max_known_txs = 10000
+        self.coalescer = SendCoalescer(self.send_batch, window=0.05, max_count=64)
+        # Accepted transactions are applied within 5 ms, or right away once 256 are waiting
+        self.apply_trigger = BatchTrigger(self.check_transactions, max_delay=0.005, batch_size=256)
+        # Blocks whose header checked out but whose body is incomplete, by block hash
+        self.partial_blocks = OrderedDict()
+        self.max_partial_blocks = 16
+        self.sync = ChainSync(window=64, max_in_flight=8, request_timeout=5.0)
+        # Proof of work and Merkle roots of synced blocks are checked on worker processes
+        self.validation = ValidationEngine()
+        self.max_headers = 128
         self.add_message_handler(SignedTransaction, self.on_transaction)
-        # self.add_message_handler(BlockMessage, self.on_block_message)
+        self.add_message_handler(TransactionBatch, self.on_transaction_batch)
+        self.add_message_handler(TransactionInventory, self.on_inventory)
+        self.add_message_handler(TransactionRequest, self.on_transaction_request)
+        self.add_message_handler(CompactBlock, self.on_compact_block)
+        self.add_message_handler(BlockTransactionsRequest, self.on_block_transactions_request)
+        self.add_message_handler(BlockTransactions, self.on_block_transactions)
+        self.add_message_handler(BlockMessage, self.on_block_message)
+        self.add_message_handler(BlockBodyRequest, self.on_block_body_request)
+        self.add_message_handler(BlockBody, self.on_block_body)
+        self.add_message_handler(ChainStatus, self.on_chain_status)
+        self.add_message_handler(GetHeaders, self.on_get_headers)
+        self.add_message_handler(Headers, self.on_headers)
         self.miner_address = b64encode(self.my_peer.public_key.key_to_bin()).decode(
             "utf-8"
         )
         
-        self.mempool = []
+        self.mempool = TransactionStore(self.accounts)
         self.node_id = 0
         self.difficulty_target = 4
-        self.block_size = 3
-        self.active_mining = False
+        # Every block takes as much of the mempool as one body message can carry
+        self.assembler = BlockAssembler(max_count=2000, max_bytes=MAX_BODY_BYTES, min_count=1)
         
         
     async def started(self, node_id) -> None:
-        self.register_task(
-            "check_transactions", self.check_transactions, interval=1.0, delay=1.0
-        )
+        self.register_task("verify_signatures", self.verifier.run)
+        self.register_task("announce_inventory", self.announce_inventory, interval=0.1, delay=0.1)
+        self.register_task("retry_requests", self.retry_requests, interval=0.5, delay=0.5)
         self.node_id = node_id
         
         print(f"Node ID: {self.node_id}")
 
-        # initialize Block class
-        self.blockchain = Blockchain(node_id, self.difficulty_target)
+        # initialize Block class, starting from the last snapshot of the ledger if there is one
+        store_dir = f"chaindata/node_{node_id}"
+        self.snapshot_path = os.path.join(store_dir, "snapshot.bin")
+        snapshot = read_snapshot(self.snapshot_path)
+        self.blockchain = Blockchain(node_id, self.difficulty_target, store_dir=store_dir, snapshot=snapshot)
+        self.snapshot_state = None
+        self.register_task("save_snapshot", self.save_snapshot, interval=30.0, delay=30.0)
+
+        # Blocks are built and mined in the background, see BlockPipeline
+        self.pipeline = BlockPipeline(self.blockchain, self.select_block_transactions, self.publish_block,
+                                      min_transactions=self.assembler.min_count)
+        self.register_task("block_pipeline", self.pipeline.run)
+        if snapshot is not None:
+            self.restore_snapshot(snapshot)
 
         
         # self.register_task("mine_block", self.mine_block_task, interval=5.0, delay=5.0)
-        # self.register_task("sync_chain", self.sync_chain, interval=10.0, delay=10.0)
+        self.register_task("sync_chain", self.sync_chain, interval=5.0, delay=5.0)
+        self.register_task("download_blocks", self.download_blocks, interval=0.5, delay=0.5)
+
+    async def unload(self) -> None:
+        self.apply_trigger.cancel()
+        self.verifier.shutdown()
+        self.validation.shutdown()
+        self.blockchain.mining_engine.shutdown()
+        self.blockchain.chain.close()
+        await super().unload()
+
+    async def save_snapshot(self) -> None:
+        """Write a ledger snapshot with the validator's state, encoding and writing off the event loop."""
+        state = (self.blockchain.height(), self.executed_checks, len(self.mempool))
+        if state == self.snapshot_state:
+            return
+        snapshot = self.blockchain.snapshot()
+        snapshot.seen = self.seen_txs.encode()
+        snapshot.accounts = self.accounts.state()
+        snapshot.pending = list(self.pending_txs)
+        snapshot.mempool = list(self.mempool)
+        await asyncio.get_running_loop().run_in_executor(None, write_snapshot, self.snapshot_path, snapshot)
+        self.snapshot_state = state
+        print(f"Saved ledger snapshot at height {snapshot.height}")
+
+    def restore_snapshot(self, snapshot) -> None:
+        """Take back the dedup window together with the transactions and balances it accounts for."""
+        if snapshot.seen:
+            self.seen_txs.restore(snapshot.seen)
+        self.accounts.restore(snapshot.accounts)
+        for tx in snapshot.pending:
+            self.pending_txs.add(tx)
+        self.mempool.extend(snapshot.mempool)
+        for signed_tx in snapshot.mempool:
+            self.known_txs[signed_tx.digest()] = signed_tx
+        self.apply_trigger.notify()
+        self.pipeline.update()
 
     def serialize_transaction(self, tx: Transaction) -> bytes:
-        return json.dumps(tx.__dict__, sort_keys=True).encode()
+        return tx.encode()
 
     def deserialize_transaction(self, data: bytes) -> Transaction:
-        return Transaction(**json.loads(data))
+        return Transaction.decode(data)
 
     def node_id_from_peer(self, peer: Peer) -> int:
         return int.from_bytes(peer.public_key.key_to_bin()[:4], byteorder="big")
 
     def generate_tx_id(self, tx: Transaction):
-        return hash((tx.sender, tx.receiver, tx.amount, tx.nonce, tx.ts))
+        return tx.digest()
+
+    def is_applied(self, tx: Transaction) -> bool:
+        """Whether the sender already applied a transaction with this or a later nonce."""
+        sender = self.accounts.get(tx.sender)
+        return sender is not None and tx.nonce <= self.accounts.nonces[sender]
 
     def check_transactions(self) -> None:
-        for tx in self.pending_txs:
-            if self.balances[tx.sender] - tx.amount >= 0:
-                self.balances[tx.sender] -= tx.amount
-                self.balances[tx.receiver] += tx.amount
-                self.pending_txs.remove(tx)
+        accounts = self.accounts
+        balances = accounts.balances
+        nonces = accounts.nonces
+        pending = self.pending_txs
+        blocked = set()
+        applied = 0
+        for name in pending.senders():
+            sender = accounts.id_of(name)
+            for tx in pending.queue(name):
+                if tx.nonce <= nonces[sender]:
+                    # Replay of a transaction that was already applied
+                    pending.remove(tx)
+                    continue
+                amount = tx.amount
+                if tx.nonce != nonces[sender] + 1 or balances[sender] < amount:
+                    # A nonce is missing or the balance is short; the later nonces wait for this one
+                    blocked.add(sender)
+                    break
+                receiver = accounts.id_of(tx.receiver)
+                balances[sender] -= amount
+                balances[receiver] += amount
+                nonces[sender] = tx.nonce
+                applied += 1
+                pending.remove(tx)
                 self.finalized_txs.append(tx)
                 self.current_block_txs.append(tx)
-                self.merkle_tree.add_leaf(self.serialize_transaction(tx).decode())
+                self.merkle_tree.add_leaf(tx.digest(), do_hash=False)
 
         self.executed_checks += 1
+        if blocked and applied:
+            # Senders blocked in this batch may have been paid by a later transaction of it
+            self.apply_trigger.notify()
 
             
-    def verify_signature(self, payload, tx):
+    async def check_signature(self, payload: SignedTransaction) -> bool:
+        """Verify a signature on the verifier's worker pool and remember it when it is valid."""
+        valid_signature = await self.verifier.verify(
+            b64decode(payload.public_key),
+            self.serialize_transaction(payload.transaction),
+            b64decode(payload.signature),
+        )
+        if valid_signature:
+            self.verified.add(payload)
+        return valid_signature
+
+    async def verify_block_signatures(self, block: Block) -> bool:
+        """Check the signatures of a block, sending only those not verified before to the pool."""
+        misses = [signed_tx for signed_tx in block.transactions if signed_tx not in self.verified]
+        try:
+            results = await asyncio.gather(*(self.check_signature(signed_tx) for signed_tx in misses))
+        except Exception as e:
+            print(bcolors.ERROR + f"Error verifying signatures of block {block.hash}: {e}")
+            return False
+        if not all(results):
+            print(bcolors.BADSIGNATURE + f"Block {block.hash} contains an invalid signature")
+            return False
+        print(bcolors.OKSIGNATURE + f"Verified {len(misses)} of {len(block.transactions)} signatures of block {block.hash}"
+              f" (cache hit rate {self.verified.hit_rate():.0%})")
+        return True
+
+    async def verify_signature(self, payload, tx):
         
-        # Verify the signature of the transaction
+        # Verify the signature of the transaction on the verifier's worker pool
         try:
-            valid_signature = self.crypto.is_valid_signature(
-                self.crypto.key_from_public_bin(b64decode(payload.public_key)),
-                self.serialize_transaction(tx),
-                b64decode(payload.signature),
-            )
+            valid_signature = await self.check_signature(payload)
             if not valid_signature:
                 print(
                     bcolors.BADSIGNATURE
                     + f"Invalid signature for transaction {tx.nonce} from {tx.sender}"
                 )
-                return
+                return False
         except Exception as e:
             print(bcolors.ERROR + f"Error verifying signature: {e}")
-            return
+            return False
 
         print(bcolors.OKSIGNATURE + f"Valid transaction {tx.nonce} from {tx.sender}")
 
-        self.pending_txs.append(tx)
+        if not self.pending_txs.add(tx):
+            print(bcolors.WARNING + f"Transaction {tx.nonce} from {tx.sender} not added to the mempool")
+            return False
+        self.apply_trigger.notify()
+        return True
 
-        # Send the transaction to another peers
-        for peer in self.get_peers():
-            self.ez_send(peer, payload)
-            
-            
+    def relay_transaction(self, source: Peer, payload: SignedTransaction) -> None:
+        """Keep the body for requests and announce its id to the other peers."""
+        tx_id = self.generate_tx_id(payload.transaction)
+        self.known_txs[tx_id] = payload
+        if len(self.known_txs) > self.max_known_txs:
+            self.known_txs.popitem(last=False)
+        self.gossip.announce(tx_id, self.get_peers(), source)
+
+    def announce_inventory(self) -> None:
+        for peer, tx_ids in self.gossip.take_announcements():
+            self.ez_send(peer, TransactionInventory(pack_ids(tx_ids)))
+
+    def retry_requests(self) -> None:
+        for peer, tx_ids in self.gossip.retry_expired():
+            self.ez_send(peer, TransactionRequest(pack_ids(tx_ids)))
+
+    @lazy_wrapper(TransactionInventory)
+    def on_inventory(self, peer: Peer, payload: TransactionInventory) -> None:
+        """Request the announced transactions we have not seen yet."""
+        missing = [tx_id for tx_id in unpack_ids(payload.tx_ids) if tx_id not in self.seen_txs]
+        request = self.gossip.on_announced(peer, missing)
+        if request:
+            self.ez_send(peer, TransactionRequest(pack_ids(request)))
+
+    @lazy_wrapper(TransactionRequest)
+    def on_transaction_request(self, peer: Peer, payload: TransactionRequest) -> None:
+        """Send the bodies of requested transactions that we still hold."""
+        for tx_id in unpack_ids(payload.tx_ids):
+            signed_tx = self.known_txs.get(tx_id)
+            if signed_tx is not None:
+                self.coalescer.add(peer, signed_tx)
+
+    def send_batch(self, peer: Peer, signed_txs) -> None:
+        self.ez_send(peer, TransactionBatch(signed_txs))
+
+    @lazy_wrapper(TransactionBatch)
+    async def on_transaction_batch(self, peer: Peer, payload: TransactionBatch) -> None:
+        """Handle every transaction of a batch like a single incoming transaction."""
+        await asyncio.gather(*(self.process_transaction(peer, signed_tx) for signed_tx in payload.transactions))
 
     @lazy_wrapper(SignedTransaction)
     async def on_transaction(self, peer: Peer, payload: SignedTransaction) -> None:
         """Handle incoming transactions from peers."""
+        await self.process_transaction(peer, payload)
 
+    async def process_transaction(self, peer: Peer, payload: SignedTransaction) -> None:
         tx: Transaction = payload.transaction
 
         # Check if the transaction has already been received
-        if self.generate_tx_id(tx) in self.saved_txs_hashes:
+        tx_id = self.generate_tx_id(tx)
+        if tx_id in self.seen_txs:
             print(bcolors.WARNING + f"Transaction {tx.nonce} already received")
             return
 
-        self.saved_txs_hashes[self.generate_tx_id(tx)] = True
+        self.seen_txs.add(tx_id)
+        self.gossip.on_received(tx_id)
         print(
             bcolors.ONTRANSACTION
             + f"Received transaction {tx.nonce} from {tx.sender} in a validator community"
         )
+
+        # The seen window forgets ids after a while, the applied nonces do not
+        if self.is_applied(tx):
+            print(bcolors.WARNING + f"Transaction {tx.nonce} from {tx.sender} was already applied")
+            return
+        # Balances are 64-bit; a positive amount is covered by the sender, so it can not overflow them
+        if tx.amount <= 0:
+            print(bcolors.WARNING + f"Transaction {tx.nonce} from {tx.sender} has a non-positive amount")
+            return
     
         # Verify the signature of the transaction
-        self.verify_signature(payload, tx)
+        if not await self.verify_signature(payload, tx):
+            return
+
+        # Announce the transaction; peers that lack it will request the body
+        self.relay_transaction(peer, payload)
         
-        # add the transaction to the mempool
-        self.mempool.append(tx)
+        # add the transaction to the mempool, with its signature for the block
+        self.mempool.append(payload)
         
         print(f"Mempool: {self.mempool}")
-        
-        # if the mempool has at least 3 transactions, create a block and bass it to mine_block
-        if len(self.mempool) >= self.block_size:
-            
-            if self.blockchain.active_mining:
-                print("Mining in progress")
-                return
-            
-            
-            # pick 3 transactions from the mempool
-            self.current_block_txs = self.mempool[:self.block_size]
-            
-            # print(f"Current block txs: {self.current_block_txs}")
-            
-            await self.blockchain.create_new_block(self.current_block_txs)
-            
+        self.pipeline.update()
+
+    def select_block_transactions(self) -> list:
+        """Pick the transactions of the next block template from the mempool."""
+        self.current_block_txs = self.mempool.select(self.assembler.select(self.mempool))
+        return list(self.current_block_txs)
+
+    def publish_block(self, block: Block) -> None:
+        """Drop the transactions of a block we mined from the mempool and announce the block."""
+        self.remove_included(block)
+        self.broadcast_block(block)
+
+    def remove_included(self, block: Block) -> None:
+        self.mempool = self.mempool.without({tx.digest() for tx in block.transactions})
+
+    def update_mempool(self, connected, disconnected) -> None:
+        """Drop the transactions of blocks that became active and take back those of disconnected blocks.
+
+        Transactions of a disconnected block that the new branch does not
+        contain would otherwise be lost, since they left the mempool when
+        their block was connected.
+        """
+        included = {tx.digest() for block in connected for tx in block.transactions}
+        self.mempool = self.mempool.without(included)
+        if disconnected:
+            present = {self.mempool.digest(index) for index in range(len(self.mempool))}
+            for block in disconnected:
+                for signed_tx in block.transactions:
+                    tx_id = signed_tx.digest()
+                    if tx_id not in included and tx_id not in present:
+                        present.add(tx_id)
+                        self.mempool.append(signed_tx)
+            print(bcolors.WARNING + f"Mempool: {self.mempool} after disconnecting {len(disconnected)} blocks")
 
+    def broadcast_block(self, block: Block, source: Peer = None) -> None:
+        """Send the header and short transaction ids of a block to every peer but its source."""
+        salt = new_salt()
+        payload = CompactBlock(block.header.to_message(), salt,
+                               pack_short_ids(salt, [tx.digest() for tx in block.transactions]))
         for peer in self.get_peers():
-            self.ez_send(peer, payload)
-        
+            if peer != source:
+                self.ez_send(peer, payload)
+
+    def is_new_header(self, header: BlockHeader) -> bool:
+        """A header worth fetching a body for: unknown, not being fetched, and with a valid proof of work."""
+        if header.hash in self.partial_blocks or self.blockchain.get_block(header.hash):
+            return False
+        if not self.blockchain.check_header(header):
+            print(bcolors.ERROR + f"Block {header.hash} has an invalid proof of work")
+            return False
+        return True
+
+    @lazy_wrapper(CompactBlock)
+    async def on_compact_block(self, peer: Peer, payload: CompactBlock) -> None:
+        """Rebuild a block from known transactions and request only the missing ones."""
+        header = BlockHeader.from_message(payload.header)
+        print(bcolors.ONBLOCKMESSAGE + f"Received compact block {header.hash} from {self.node_id_from_peer(peer)}")
+        if not self.is_new_header(header):
+            return
+
+        partial = PartialBlock(header, payload.salt, unpack_short_ids(payload.short_ids), self.known_txs.values())
+        missing = partial.missing()
+        if not missing:
+            await self.complete_block(peer, Block(header, partial.transactions))
+            return
+
+        self.add_partial_block(header.hash, partial)
+        self.ez_send(peer, BlockTransactionsRequest(header.hash, pack_indexes(missing)))
+
+    @lazy_wrapper(BlockMessage)
+    def on_block_message(self, peer: Peer, payload: BlockMessage) -> None:
+        """Fetch the body of an announced header once its proof of work checks out."""
+        header = BlockHeader.from_message(payload)
+        print(bcolors.ONBLOCKMESSAGE + f"Received block header {header.hash} from {self.node_id_from_peer(peer)}")
+        if not self.is_new_header(header):
+            return
+        self.add_partial_block(header.hash, PartialBlock(header, b'', [], ()))
+        self.ez_send(peer, BlockBodyRequest(header.hash))
+
+    def add_partial_block(self, block_hash: str, partial: PartialBlock) -> None:
+        self.partial_blocks[block_hash] = partial
+        if len(self.partial_blocks) > self.max_partial_blocks:
+            self.partial_blocks.popitem(last=False)
+
+    @lazy_wrapper(BlockTransactionsRequest)
+    def on_block_transactions_request(self, peer: Peer, payload: BlockTransactionsRequest) -> None:
+        block = self.blockchain.get_block(payload.block_hash)
+        if block is None:
+            return
+        indexes = [index for index in unpack_indexes(payload.indexes) if index < len(block.transactions)]
+        transactions = [block.transactions[index] for index in indexes]
+        self.ez_send(peer, BlockTransactions(payload.block_hash, pack_indexes(indexes), transactions))
+
+    @lazy_wrapper(BlockTransactions)
+    async def on_block_transactions(self, peer: Peer, payload: BlockTransactions) -> None:
+        partial = self.partial_blocks.pop(payload.block_hash, None)
+        if partial is None:
+            return
+        partial.fill(unpack_indexes(payload.indexes), payload.transactions)
+        if partial.is_complete():
+            await self.complete_block(peer, Block(partial.header, partial.transactions))
+        else:
+            print(bcolors.WARNING + f"Block {payload.block_hash} is still missing transactions")
+
+    @lazy_wrapper(BlockBodyRequest)
+    def on_block_body_request(self, peer: Peer, payload: BlockBodyRequest) -> None:
+        block = self.blockchain.get_block(payload.block_hash)
+        if block is not None:
+            self.ez_send(peer, BlockBody(payload.block_hash, block.transactions))
+
+    @lazy_wrapper(BlockBody)
+    async def on_block_body(self, peer: Peer, payload: BlockBody) -> None:
+        if self.sync.is_requested(payload.block_hash):
+            await self.on_synced_body(payload)
+            return
+        partial = self.partial_blocks.pop(payload.block_hash, None)
+        if partial is not None:
+            await self.complete_block(peer, Block(partial.header, payload.transactions))
+
+    def sync_chain(self) -> None:
+        """Tell peers about our chain and start catching up with the highest one."""
+        status = ChainStatus(self.blockchain.height(), self.blockchain.chain[-1].hash)
+        for peer in self.get_peers():
+            self.ez_send(peer, status)
+
+        if self.sync.is_active():
+            if not self.sync.is_stalled():
+                return
+            print(bcolors.WARNING + f"Sync with {self.node_id_from_peer(self.sync.peer)} stalled")
+            self.sync.forget(self.sync.peer)
+        peer = self.sync.best_peer(self.blockchain.height(), self.get_peers())
+        if peer is None:
+            self.sync.reset()
+            return
+        print(bcolors.ONBLOCKMESSAGE + f"Syncing headers from {self.node_id_from_peer(peer)}")
+        self.sync.start(peer)
+        self.request_headers(peer, self.blockchain.locator())
 
+    def request_headers(self, peer: Peer, locator) -> None:
+        self.ez_send(peer, GetHeaders(pack_ids([bytes.fromhex(block_hash) for block_hash in locator])))
+
+    @lazy_wrapper(ChainStatus)
+    def on_chain_status(self, peer: Peer, payload: ChainStatus) -> None:
+        self.sync.on_status(peer, payload.height)
+
+    @lazy_wrapper(GetHeaders)
+    def on_get_headers(self, peer: Peer, payload: GetHeaders) -> None:
+        locator = [block_hash.hex() for block_hash in unpack_ids(payload.locator)]
+        headers = self.blockchain.headers_after(locator, self.max_headers)
+        self.ez_send(peer, Headers([header.to_message() for header in headers]))
+
+    @lazy_wrapper(Headers)
+    async def on_headers(self, peer: Peer, payload: Headers) -> None:
+        """Check a batch of headers from the sync peer and queue their bodies for download."""
+        if peer != self.sync.peer:
+            return
+        headers = [BlockHeader.from_message(message) for message in payload.headers]
+        if self.sync.last_hash is None:
+            # The first batch may start with blocks we already have
+            while headers and self.blockchain.get_block(headers[0].hash):
+                headers.pop(0)
+        if not headers:
+            if self.sync.last_hash is None:
+                # The peer claimed a higher chain but has nothing beyond ours
+                print(bcolors.WARNING + f"{self.node_id_from_peer(peer)} has no headers beyond our chain")
+                self.sync.forget(peer)
+                self.sync.reset()
+                return
+            self.sync.headers_done = True
+            return
+
+        if self.sync.last_hash is None:
+            fork_height = self.blockchain.height_of(headers[0].prev_hash)
+            prev_hash = headers[0].prev_hash
+            start_height = fork_height + 1 if fork_height is not None else None
+        else:
+            fork_height = self.sync.fork_height
+            prev_hash = self.sync.last_hash
+            start_height = self.sync.next_height()
+        invalid_height = None
+        if start_height is not None:
+            blocks = [Block(header, None) for header in headers]
+            invalid_height = await self.validation.validate(blocks, prev_hash, start_height,
+                                                            self.blockchain.difficulty_target)
+        if peer != self.sync.peer:
+            return
+        if start_height is None or invalid_height is not None:
+            print(bcolors.ERROR + f"Invalid header at height {invalid_height} from {self.node_id_from_peer(peer)}, stopping sync")
+            self.sync.forget(peer)
+            self.sync.reset()
+            return
+
+        self.sync.add_headers(fork_height, headers)
+        if len(payload.headers) >= self.max_headers:
+            self.request_headers(peer, [self.sync.last_hash])
+        else:
+            self.sync.headers_done = True
+        self.download_blocks()
+
+    def download_blocks(self) -> None:
+        if not self.sync.is_active():
+            return
+        for peer, block_hash in self.sync.requests(self.get_peers()):
+            self.ez_send(peer, BlockBodyRequest(block_hash))
+
+    async def on_synced_body(self, payload: BlockBody) -> None:
+        """Keep a downloaded body if it matches its header and connect what is complete."""
+        header = self.sync.header(payload.block_hash)
+        if header is None:
+            return
+        block = Block(header, payload.transactions)
+        if (await self.validation.validate([block], header.prev_hash, 0, header.difficulty) is not None
+                or not await self.verify_block_signatures(block)):
+            self.sync.on_bad_body(payload.block_hash)
+            return
+        if self.sync.header(payload.block_hash) is None:
+            return
+        self.sync.on_body(payload.block_hash, payload.transactions)
+
+        branch = [Block(h, transactions) for h, transactions in self.sync.take_ready()]
+        update = self.blockchain.connect_blocks(branch) if branch else None
+        if update is not None:
+            print(bcolors.OKBLOCK + f"Synced to height {self.blockchain.height()}")
+            # Only a branch that became active takes its transactions out of the mempool
+            self.update_mempool(*update)
+            self.pipeline.update()
+            self.sync.on_connected()
+        if self.sync.is_done():
+            # Either everything is connected, or the branch turned out not to be longer
+            self.sync.reset()
+        else:
+            self.download_blocks()
+
+    async def complete_block(self, peer: Peer, block: Block) -> None:
+        if not await self.verify_block_signatures(block):
+            return
+        # The same block may have been completed from another peer meanwhile
+        if self.blockchain.get_block(block.hash):
+            return
+        update = self.blockchain.accept_block(block)
+        if update is None:
+            return
+        print(bcolors.OKBLOCK + f"Accepted block {block.hash} from {self.node_id_from_peer(peer)}")
 
+        # Transactions of the blocks that became active are taken, and a template on the old tip can no longer win
+        self.update_mempool(*update)
+        self.pipeline.update()
+        self.broadcast_block(block, peer)